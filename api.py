@@ -1,128 +1,423 @@
-from reddit_parser import FileWriter, PostsProcessor
-from utils import check_duplicates, DataConverter, find_line_index
+from functools import partial
+from jobs import job_manager
+from store import post_store
+from utils import make_date_key, Post
+import csv
+import io
 import json
+import math
+import threading
 
+DEFAULT_LISTING_URLS = ["https://www.reddit.com/top/?t=month"]
+DEFAULT_POSTS_COUNT = 100
+TRANSFER_FORMATS = {'ndjson': 'application/x-ndjson', 'csv': 'text/csv'}
+EXPORT_CHUNK_SIZE = 64 * 1024
+IMPORT_BATCH_SIZE = 1000
+scrape_lock = threading.Lock()
 
-def get_posts():
-    """Tries to convert each string from reddit-file to dictionary and add this dictionary to list.
 
-    Returns generated list in JSON format and status code 200 if reddit-file exists and isn't empty.
-    In all other cases, status code 404 is only returned.
+def get_posts(date_from=None, date_to=None):
+    """Returns JSON array assembled from cached JSON of each stored post and status code 200
+
+    if reddit-files exist and aren't empty. In all other cases, status code 404 is only returned.
+    If date_from or date_to (in the format DD.MM.YYYY) is specified, only the posts with post date
+    in this range are returned, status code 404 is returned if the dates are incorrect.
+    Header X-Last-Seq contains sequence number of the last change included in returned posts,
+    change feed can be followed from it. The header is omitted if the change feed is disabled.
     """
-    file_path = FileWriter.define_path_to_file('reddit-')
-    posts = []
-    status_code = 404
-    if file_path:
-        with open(file_path) as file:
-            for line in file:
-                post_dict = DataConverter.make_dict_from_str(line)
-                posts.append(post_dict)
-        status_code = 200
-    if not posts:
-        status_code = 404
-        return {'status_code': status_code}
-    content = json.dumps(posts)
-    return {'status_code': status_code, 'content': content}
+    with post_store.lock, post_store.process_read_lock:
+        post_store.refresh()
+        if not post_store.count():
+            return {'status_code': 404}
+        headers = {'X-Last-Seq': str(post_store.feed.last_seq)} if post_store.feed else {}
+        if date_from is None and date_to is None:
+            return {'status_code': 200, 'content': post_store.dump_all(), 'headers': headers}
+        date_from_key = make_date_key(date_from) if date_from else '00000000'
+        date_to_key = make_date_key(date_to) if date_to else '99999999'
+        if not date_from_key or not date_to_key:
+            return {'status_code': 404}
+        return {'status_code': 200, 'content': post_store.dump_range(date_from_key, date_to_key), 'headers': headers}
 
 
 def get_line(id):
-    """Tries to find a string with specified UNIQUE_ID in reddit-file.
+    """Tries to find a post with specified UNIQUE_ID using the global index of reddit-files.
 
-    If reddit-file exists and the search was successful, converts found string to dictionary
-    and returns this dictionary in JSON format with status code 200.
+    If the search was successful, returns cached JSON of found post with status code 200.
     In all other cases, status code 404 is only returned.
     """
-    file_path = FileWriter.define_path_to_file('reddit-')
-    post_dict = {}
-    status_code = 404
-    if file_path:
-        with open(file_path) as file:
-            for line in file:
-                if id in line:
-                    post_dict = DataConverter.make_dict_from_str(line)
-                    status_code = 200
-                    break
-    if not post_dict:
-        return {'status_code': status_code}
-    content = json.dumps(post_dict)
-    return {'status_code': status_code, 'content': content}
+    with post_store.lock, post_store.process_read_lock:
+        post_store.refresh()
+        content = post_store.dump_line(id)
+    if content is None:
+        return {'status_code': 404}
+    return {'status_code': 200, 'content': content}
+
+
+def get_changes(since=None, timeout=None):
+    """Returns JSON in the format {"last_seq": sequence number to continue from, "changes": [...]} containing
+
+    the changes of posts made after the change with sequence number since (the last change by default)
+    and status code 200. If there are no such changes, waits for them for no more than timeout seconds
+    (30 by default, 60 at most). If the changes following since are no longer kept, returns JSON
+    in the format {"last_seq": sequence number of the last change} and status code 410: all the posts
+    have to be reloaded. If since or timeout is incorrect or the change feed is disabled, status code 404
+    is only returned.
+    """
+    feed = post_store.feed
+    if not feed:
+        return {'status_code': 404}
+    try:
+        since = feed.last_seq if since is None else int(since)
+        timeout = 30 if timeout is None else float(timeout)
+    except ValueError:
+        return {'status_code': 404}
+    if not math.isfinite(timeout):
+        return {'status_code': 404}
+    timeout = min(max(timeout, 0), 60)
+    changes = feed.wait_for_changes(since, timeout)
+    if changes is None:
+        return {'status_code': 410, 'content': json.dumps({'last_seq': feed.last_seq})}
+    last_seq = changes[-1].seq if changes else since
+    return {'status_code': 200, 'content': feed.dump(changes, last_seq)}
+
+
+def stream_changes(since=None):
+    """Returns generator of Server-Sent Events messages describing the changes of posts made after the change
+
+    with sequence number since (the last change by default) and status code 200. If since is incorrect
+    or the change feed is disabled, status code 404 is only returned.
+    """
+    if not post_store.feed:
+        return {'status_code': 404}
+    try:
+        since = post_store.feed.last_seq if since is None else int(since)
+    except ValueError:
+        return {'status_code': 404}
+    return {'status_code': 200, 'content': generate_change_events(since)}
+
+
+def generate_change_events(since, heartbeat_interval=15):
+    """Yields messages with new changes as soon as they are published. Yields comment message if there are
+
+    no changes during heartbeat_interval seconds. If the changes following since are no longer kept,
+    yields "reset" message containing sequence number of the last change and stops.
+    """
+    feed = post_store.feed
+    while True:
+        changes = feed.wait_for_changes(since, heartbeat_interval)
+        if changes is None:
+            yield b'event: reset\ndata: {"last_seq": %d}\n\n' % feed.last_seq
+            return
+        if not changes:
+            yield b': keepalive\n\n'
+            continue
+        since = changes[-1].seq
+        yield b''.join(change.to_sse() for change in changes)
 
 
 def add_line(post_dict):
-    """Takes post data in JSON format, converts it to string and tries to add to reddit-file.
-
-    If file doesn't exist the new one is generated. Returns JSON in the format {"UNIQUE_ID": inserted line number}
-    and status code 201 if successful. If equal post data already exists in reddit-file, only returns status code 409.
-    In all other cases, including incorrect post data, status code 404 is only returned.
-    """
-    file_path = FileWriter.define_path_to_file('reddit-')
-    posts_list = []
-    status_code = 404
-    if not file_path:
-        PostsProcessor("https://www.reddit.com/top/?t=month", 100)
-        file_path = FileWriter.define_path_to_file('reddit-')
-    post_dict = json.loads(post_dict)
-    if len(post_dict) == 11:
-        post_data_str = DataConverter.make_str_from_dict(post_dict)
-        posts_list = open(file_path).readlines()
-        if check_duplicates(post_data_str, posts_list):
-            if posts_list:
-                posts_list[len(posts_list) - 1] += '\n'
-            posts_list.append(post_data_str)
-            with open(file_path, 'w') as file:
-                file.writelines(posts_list)
-            status_code = 201
-        else:
-            status_code = 409
-    if not status_code == 201:
-        return {'status_code': status_code}
-    content = json.dumps({'UNIQUE_ID': len(posts_list)})
-    return {'status_code': status_code, 'content': content}
+    """Takes post data in JSON format, converts it to post record and tries to add to reddit-file of its post date.
+
+    Returns JSON in the format {"UNIQUE_ID": inserted line number} where line number is counted through
+    all reddit-files and status code 201 if successful. If equal post data already exists in reddit-files,
+    only returns status code 409. If no reddit-files exist, starts background job generating them by the parser
+    (or joins the running one) and returns JSON in the format {"JOB_ID": job id} and status code 202:
+    the post is added when the job finishes. While reddit-files are shared by several worker processes,
+    the parser isn't started implicitly, as the other workers wouldn't know about the job, and the post is added
+    right away. In all other cases, including incorrect post data, status code 404 is only returned.
+    """
+    post = parse_post(post_dict)
+    if not post:
+        return {'status_code': 404}
+    with scrape_lock:
+        with post_store.lock, post_store.process_read_lock:
+            post_store.refresh()
+            store_is_empty = not post_store.partitions
+        if store_is_empty and not post_store.shared:
+            job = job_manager.find_active('scrape')
+            if not job or job.inbox is None:
+                job = start_scrape_job(DEFAULT_LISTING_URLS, DEFAULT_POSTS_COUNT)
+            job.inbox.append(post)
+            return {'status_code': 202, 'content': json.dumps({'JOB_ID': job.id})}
+    return post_store.execute(partial(insert_post, post))
 
 
 def del_line(id):
-    """Tries to find a string with specified UNIQUE_ID in reddit-file. If reddit-file exists
+    """Tries to find a string with specified UNIQUE_ID in reddit-files. If the search was successful,
 
-    and the search was successful, deletes found string from the file and returns status code 200.
+    deletes found string from its file and returns status code 200.
     In all other cases, status code 404 is returned.
     """
-    file_path = FileWriter.define_path_to_file('reddit-')
-    status_code = 404
-    if file_path:
-        posts_list = open(file_path).readlines()
-        line_index = find_line_index(id, posts_list)
-        if line_index:
-            del posts_list[line_index]
-            posts_list[len(posts_list) - 1] = posts_list[len(posts_list) - 1].replace('\n', '')
-            with open(file_path, 'w') as file:
-                file.writelines(posts_list)
-            status_code = 200
-    return {'status_code': status_code}
+    return post_store.execute(partial(delete_post, id))
 
 
 def change_line(id, post_dict):
-    """Takes post data in JSON format, converts it to string and tries to modify the content
+    """Takes post data in JSON format, converts it to post record and tries to modify the content
 
-    of a line with specified UNIQUE_ID in reddit-file. Returns status code 200 if successful.
-    If equal post data already exists in the file, returns status code 409.
+    of a line with specified UNIQUE_ID in reddit-files. The line stays in the same file. Returns status code 200
+    if successful. If equal post data or another post with the same UNIQUE_ID already exists, returns status code 409.
     In all other cases, status code 404 is returned.
     """
-    file_path = FileWriter.define_path_to_file('reddit-')
-    status_code = 404
-    if file_path:
-        post_dict = json.loads(post_dict)
-        if len(post_dict) == 11:
-            posts_list = open(file_path).readlines()
-            line_index = find_line_index(id, posts_list)
-            if line_index:
-                post_data_str = DataConverter.make_str_from_dict(post_dict)
-                if post_data_str != posts_list[line_index].replace('\n', ''):
-                    if line_index != len(posts_list):
-                        post_data_str += '\n'
-                    posts_list[line_index] = post_data_str
-                    with open(file_path, 'w') as file:
-                        file.writelines(posts_list)
-                    status_code = 200
-                else:
-                    status_code = 409
-    return {'status_code': status_code}
+    post = parse_post(post_dict)
+    if not post:
+        return {'status_code': 404}
+    return post_store.execute(partial(replace_post, id, post))
+
+
+def get_jobs():
+    """Returns JSON array describing state of all known background jobs and status code 200.
+
+    While reddit-files are shared by several worker processes, jobs are disabled and status code 404 is only returned.
+    """
+    if post_store.shared:
+        return {'status_code': 404}
+    content = json.dumps([job.to_dict() for job in job_manager.get_all()])
+    return {'status_code': 200, 'content': content}
+
+
+def get_job(id):
+    """Returns JSON describing state and progress of the background job with specified id and status code 200.
+
+    If the job isn't found or jobs are disabled, status code 404 is only returned.
+    """
+    if post_store.shared:
+        return {'status_code': 404}
+    job = job_manager.get(id)
+    if not job:
+        return {'status_code': 404}
+    return {'status_code': 200, 'content': json.dumps(job.to_dict())}
+
+
+def add_job(job_data):
+    """Takes parser settings in JSON format {"urls": [listing URLs], "posts_count": count of posts}, both are optional,
+
+    and starts background job which adds parsed posts to reddit-files. Returns JSON in the format
+    {"JOB_ID": job id} and status code 202 if successful. If the parser is already running, returns
+    JSON with id of the running job and status code 409. If settings are incorrect or jobs are disabled
+    (while reddit-files are shared by several worker processes, as each of them would run its own parser),
+    status code 404 is only returned.
+    """
+    if post_store.shared:
+        return {'status_code': 404}
+    try:
+        job_data = json.loads(job_data or '{}')
+    except ValueError:
+        return {'status_code': 404}
+    if not isinstance(job_data, dict):
+        return {'status_code': 404}
+    urls = job_data.get('urls', DEFAULT_LISTING_URLS)
+    posts_count = job_data.get('posts_count', DEFAULT_POSTS_COUNT)
+    urls_are_correct = isinstance(urls, list) and urls and all(isinstance(url, str) for url in urls)
+    if not urls_are_correct or not isinstance(posts_count, int) or posts_count <= 0:
+        return {'status_code': 404}
+    with scrape_lock:
+        job = job_manager.find_active('scrape')
+        if job:
+            return {'status_code': 409, 'content': json.dumps({'JOB_ID': job.id})}
+        job = start_scrape_job(urls, posts_count)
+    return {'status_code': 202, 'content': json.dumps({'JOB_ID': job.id})}
+
+
+def start_scrape_job(urls, posts_count):
+    """Starts background job running the parser. Has to be called while holding scrape lock"""
+    return job_manager.start('scrape', run_scrape_job, urls, posts_count)
+
+
+def run_scrape_job(job, urls, posts_count):
+    """Runs the parser and adds parsed posts to reddit-files. Then adds the posts handed over to the job
+
+    while it was running. Parser dependencies are imported here, so they aren't loaded until the first job.
+    Returns the count of added parsed posts and the results of adding the handed over posts,
+    the result is kept by the job even if the parser fails.
+    """
+    from reddit_parser import PostsProcessor
+
+    added_posts_counts = []
+    try:
+        PostsProcessor(urls, posts_count, writer=lambda posts: added_posts_counts.append(store_posts(posts)),
+                       progress=job.set_progress)
+    finally:
+        with scrape_lock:
+            handed_over_posts = job.inbox
+            job.inbox = None
+            results = [post_store.execute(partial(insert_post, post)) for post in handed_over_posts]
+        job.result = {'posts_added': sum(added_posts_counts),
+                      'handed_over_posts': [{'UNIQUE_ID': post.unique_id, 'status_code': result['status_code']}
+                                            for post, result in zip(handed_over_posts, results)]}
+    return job.result
+
+
+def store_posts(posts):
+    """Adds post records to reddit-files skipping the posts already stored. Returns the count of added posts"""
+    return post_store.execute(partial(insert_posts, posts))
+
+
+def insert_posts(posts):
+    """Adds post records to the store applying the rules of add_line to the whole list at once: the posts
+
+    whose UNIQUE_ID is already stored or repeats UNIQUE_ID of a previous post from the list are skipped.
+    Returns the count of added posts. Is executed by the store as a change which is committed to reddit-files.
+    """
+    post_store.refresh()
+    unique_posts = {}
+    for post in posts:
+        unique_posts.setdefault(post.unique_id, post)
+    stored_ids = post_store.find_stored_ids(unique_posts.keys())
+    added_count = 0
+    for id, post in unique_posts.items():
+        if id not in stored_ids:
+            post_store.append(post)
+            added_count += 1
+    return added_count
+
+
+def export_posts(export_format='ndjson'):
+    """Returns generator of chunks of all stored posts in NDJSON or CSV format (with header row), its content type
+
+    and status code 200. Each chunk is about 64 KB. If the format is unknown, status code 404 is only returned.
+    """
+    if export_format not in TRANSFER_FORMATS:
+        return {'status_code': 404}
+    generate_chunks = generate_ndjson_chunks if export_format == 'ndjson' else generate_csv_chunks
+    return {'status_code': 200, 'content_type': TRANSFER_FORMATS[export_format],
+            'content': generate_chunks(EXPORT_CHUNK_SIZE)}
+
+
+def generate_ndjson_chunks(chunk_size):
+    """Yields JSON of stored posts, one post per line, joined into chunks of at least chunk_size bytes"""
+    lines = []
+    lines_size = 0
+    for post, fragment in post_store.iterate_posts():
+        line = (fragment or post.to_json()) + b'\n'
+        lines.append(line)
+        lines_size += len(line)
+        if lines_size >= chunk_size:
+            yield b''.join(lines)
+            lines = []
+            lines_size = 0
+    if lines:
+        yield b''.join(lines)
+
+
+def generate_csv_chunks(chunk_size):
+    """Yields header row and rows of stored posts in CSV format joined into chunks of at least chunk_size bytes"""
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(Post.display_names)
+    for post, _ in post_store.iterate_posts():
+        writer.writerow(post.values())
+        if buffer.tell() >= chunk_size:
+            yield buffer.getvalue().encode('utf-8')
+            buffer.seek(0)
+            buffer.truncate()
+    if buffer.tell():
+        yield buffer.getvalue().encode('utf-8')
+
+
+def import_posts(lines, import_format='ndjson'):
+    """Takes iterable of lines in NDJSON or CSV format (with header row) and adds the posts to reddit-files
+
+    in batches of 1000 posts following the rules of add_line. Returns JSON in the format
+    {"imported": count of added posts, "duplicates": count of skipped duplicates, "invalid": count of incorrect posts}
+    and status code 200. If the format is unknown, status code 404 is only returned.
+    """
+    if import_format not in TRANSFER_FORMATS:
+        return {'status_code': 404}
+    parse_lines = parse_ndjson_lines if import_format == 'ndjson' else parse_csv_lines
+    counts = {'imported': 0, 'duplicates': 0, 'invalid': 0}
+    batch = []
+    for post in parse_lines(lines):
+        if post is None:
+            counts['invalid'] += 1
+            continue
+        batch.append(post)
+        if len(batch) == IMPORT_BATCH_SIZE:
+            add_imported_posts(batch, counts)
+            batch = []
+    if batch:
+        add_imported_posts(batch, counts)
+    return {'status_code': 200, 'content': json.dumps(counts)}
+
+
+def add_imported_posts(posts, counts):
+    """Adds the batch of imported posts to reddit-files, updates the counts of added and duplicate posts"""
+    added_count = store_posts(posts)
+    counts['imported'] += added_count
+    counts['duplicates'] += len(posts) - added_count
+
+
+def parse_ndjson_lines(lines):
+    """Yields post record for each non-empty line containing post data in JSON format, None for incorrect lines"""
+    for line in lines:
+        if line.strip():
+            try:
+                yield parse_post(line)
+            except ValueError:
+                yield
+
+
+def parse_csv_lines(lines):
+    """Yields post record for each CSV row following the header row, None for incorrect rows"""
+    for row in csv.DictReader(lines):
+        if None in row or None in row.values():
+            yield
+            continue
+        try:
+            yield Post.from_dict(row)
+        except ValueError:
+            yield
+
+
+def insert_post(post):
+    """Adds post record to the store unless a post with the same UNIQUE_ID is already stored.
+
+    Is executed by the store as a change which is committed to reddit-files.
+    """
+    post_store.refresh()
+    if post_store.contains(post.unique_id):
+        return {'status_code': 409}
+    line_number = post_store.append(post)
+    content = json.dumps({'UNIQUE_ID': line_number})
+    return {'status_code': 201, 'content': content}
+
+
+def delete_post(id):
+    """Removes post with specified UNIQUE_ID from the store.
+
+    Is executed by the store as a change which is committed to reddit-files.
+    """
+    post_store.refresh()
+    if not post_store.contains(id):
+        return {'status_code': 404}
+    post_store.delete(id)
+    return {'status_code': 200}
+
+
+def replace_post(id, post):
+    """Replaces post with specified UNIQUE_ID in the store by the new post record.
+
+    Is executed by the store as a change which is committed to reddit-files.
+    """
+    post_store.refresh()
+    stored_post = post_store.get(id)
+    if stored_post is None:
+        return {'status_code': 404}
+    new_id = post.unique_id
+    if post == stored_post or (new_id != id and post_store.contains(new_id)):
+        return {'status_code': 409}
+    post_store.replace(id, post)
+    return {'status_code': 200}
+
+
+def parse_post(post_json):
+    """Converts post data in JSON format to post record. Returns None if post data is incorrect"""
+    try:
+        post_dict = json.loads(post_json)
+    except ValueError:
+        return
+    if not isinstance(post_dict, dict):
+        return
+    try:
+        return Post.from_dict(post_dict)
+    except ValueError:
+        return
@@ -0,0 +1,79 @@
+import collections
+import itertools
+import json
+import threading
+
+
+class ChangeEvent:
+    __slots__ = ('seq', 'operation', 'id', 'fragment')
+
+    def __init__(self, seq, operation, id, fragment):
+        """Takes sequence number of the change, operation name ("add", "change" or "delete"), UNIQUE_ID
+
+        of the changed post and JSON of the post after the change (None for deleted posts).
+        """
+        self.seq = seq
+        self.operation = operation
+        self.id = id
+        self.fragment = fragment
+
+    def to_json(self):
+        """Converts the event to JSON bytes reusing JSON of the post"""
+        return b'{"seq": %d, "op": "%s", "id": %s, "post": %s}' % (
+            self.seq, self.operation.encode(), json.dumps(self.id).encode(), self.fragment or b'null')
+
+    def to_sse(self):
+        """Converts the event to Server-Sent Events message"""
+        return b'id: %d\nevent: %s\ndata: %s\n\n' % (self.seq, self.operation.encode(), self.to_json())
+
+
+class ChangeFeed:
+    def __init__(self, capacity=10000):
+        """Keeps last capacity changes of the stored posts. Each change gets monotonically increasing
+
+        sequence number starting from 1. Clients which fell off the end of the log have to reload all the posts.
+        """
+        self.capacity = capacity
+        self.log = collections.deque(maxlen=capacity)
+        self.last_seq = 0
+        self.condition = threading.Condition()
+
+    def publish(self, changes):
+        """Takes list of tuples (operation, UNIQUE_ID, post JSON) describing committed changes,
+
+        appends them to the log and wakes up waiting clients.
+        """
+        if not changes:
+            return
+        with self.condition:
+            for operation, id, fragment in changes:
+                self.last_seq += 1
+                self.log.append(ChangeEvent(self.last_seq, operation, id, fragment))
+            self.condition.notify_all()
+
+    def wait_for_changes(self, since, timeout):
+        """Returns list of the changes having sequence number greater than since. If there are no such changes,
+
+        waits for them for no more than timeout seconds and returns empty list if none appeared.
+        Returns None if the changes following since are no longer kept in the log or since is unknown.
+        """
+        with self.condition:
+            if not self.is_available(since):
+                return
+            self.condition.wait_for(lambda: self.last_seq > since, timeout)
+            if not self.is_available(since):
+                return
+            first_seq = self.log[0].seq if self.log else self.last_seq + 1
+            return list(itertools.islice(self.log, since + 1 - first_seq, None))
+
+    def is_available(self, since):
+        """Defines whether all the changes following since are kept in the log"""
+        if since < 0 or since > self.last_seq:
+            return False
+        first_seq = self.log[0].seq if self.log else self.last_seq + 1
+        return since + 1 >= first_seq
+
+    @staticmethod
+    def dump(changes, last_seq):
+        """Returns JSON object containing the changes and the sequence number to continue from"""
+        return b'{"last_seq": %d, "changes": [%s]}' % (last_seq, b', '.join(change.to_json() for change in changes))
@@ -0,0 +1,109 @@
+import collections
+import datetime
+import logging
+import threading
+import uuid
+
+
+class Job:
+    def __init__(self, kind):
+        """Takes the kind of the background job. Generates 32-digits job id.
+
+        Inbox is a list for the items handed over to the job while it's running, it's set to None
+        when the job doesn't accept items any more.
+        """
+        self.id = uuid.uuid4().hex
+        self.kind = kind
+        self.status = 'pending'
+        self.progress = {}
+        self.result = None
+        self.error = None
+        self.inbox = []
+        self.created = datetime.datetime.now()
+        self.started = None
+        self.finished = None
+
+    def is_active(self):
+        """Defines whether the job is waiting for start or running"""
+        return self.status in ('pending', 'running')
+
+    def set_progress(self, stage, done, total):
+        """Remembers the current stage of the job and the count of processed items"""
+        self.progress = {'stage': stage, 'done': done, 'total': total}
+
+    def to_dict(self):
+        """Describes the job state in the dictionary"""
+        return {'JOB_ID': self.id, 'kind': self.kind, 'status': self.status, 'progress': self.progress,
+                'result': self.result, 'error': self.error, 'created': self.format_time(self.created),
+                'started': self.format_time(self.started), 'finished': self.format_time(self.finished)}
+
+    @staticmethod
+    def format_time(moment):
+        """Converts datetime to string in ISO format"""
+        return moment.isoformat(timespec='seconds') if moment else None
+
+
+class JobManager:
+    def __init__(self, history_size=100):
+        """Runs background jobs in separate threads, keeps the state of active jobs
+
+        and of history_size last finished ones.
+        """
+        self.history_size = history_size
+        self.jobs = collections.OrderedDict()
+        self.lock = threading.Lock()
+
+    def start(self, kind, target, *args):
+        """Starts a job of specified kind calling target with the job and args in a separate thread.
+
+        The value returned by target is used as the job result. Returns the job.
+        """
+        job = Job(kind)
+        with self.lock:
+            self.jobs[job.id] = job
+            self.forget_finished_jobs()
+        thread = threading.Thread(target=self.run, args=(job, target, args), name=f'{kind}-job', daemon=True)
+        thread.start()
+        return job
+
+    def run(self, job, target, args):
+        """Calls job target, stores its result or the error raised"""
+        job.status = 'running'
+        job.started = datetime.datetime.now()
+        logging.info(f'Job started, job: {job.kind} {job.id}')
+        try:
+            job.result = target(job, *args)
+            job.status = 'done'
+            logging.info(f'Job done, job: {job.kind} {job.id}')
+        except Exception as err:
+            job.status = 'failed'
+            job.error = f'{type(err).__name__}: {err}'
+            logging.exception(f'Job failed, job: {job.kind} {job.id}')
+        finally:
+            job.finished = datetime.datetime.now()
+
+    def forget_finished_jobs(self):
+        """Removes the oldest finished jobs exceeding history size"""
+        finished_ids = [id for id, job in self.jobs.items() if not job.is_active()]
+        for id in finished_ids[:max(len(finished_ids) - self.history_size, 0)]:
+            del self.jobs[id]
+
+    def get(self, id):
+        """Returns the job with specified id or None if the job isn't found"""
+        with self.lock:
+            return self.jobs.get(id)
+
+    def get_all(self):
+        """Returns list of all known jobs in the order of their creation"""
+        with self.lock:
+            return list(self.jobs.values())
+
+    def find_active(self, kind):
+        """Returns active job of specified kind or None if there is no such job"""
+        with self.lock:
+            for job in self.jobs.values():
+                if job.kind == kind and job.is_active():
+                    return job
+
+
+job_manager = JobManager()
@@ -1,11 +1,17 @@
 from bs4 import BeautifulSoup
+from concurrent.futures import ThreadPoolExecutor
 from selenium import webdriver
+from selenium.common.exceptions import TimeoutException
 from selenium.webdriver.support.ui import WebDriverWait
-from utils import DataConverter
+from utils import DataConverter, Post
+import atexit
 import datetime
 import logging
 import os
+import queue
 import requests
+import sys
+import threading
 import time
 import uuid
 
@@ -34,35 +40,113 @@ class PageLoader:
         driver.execute_script("window.scrollTo(0, document.body.scrollHeight);")
 
 
+class BrowserPool:
+    def __init__(self, size):
+        """Takes the maximum number of simultaneously opened browser sessions.
+
+        Sessions are started lazily on first demand and kept alive between scraping runs.
+        """
+        self.size = size
+        self.idle_drivers = queue.LifoQueue()
+        self.sessions_limit = threading.BoundedSemaphore(size)
+
+    def acquire(self):
+        """Waits for a free slot in the pool and returns an idle browser session, starting a new one if necessary"""
+        self.sessions_limit.acquire()
+        try:
+            return self.idle_drivers.get_nowait()
+        except queue.Empty:
+            pass
+        try:
+            return self.create_driver()
+        except Exception:
+            self.sessions_limit.release()
+            raise
+
+    def release(self, driver, broken=False):
+        """Returns browser session to the pool. Broken session is closed instead of being reused"""
+        try:
+            if broken:
+                driver.quit()
+            else:
+                self.idle_drivers.put(driver)
+        finally:
+            self.sessions_limit.release()
+
+    def close(self):
+        """Closes all idle browser sessions"""
+        while True:
+            try:
+                driver = self.idle_drivers.get_nowait()
+            except queue.Empty:
+                return
+            try:
+                driver.quit()
+            except Exception:
+                logging.exception('Failed to close browser session')
+
+    @staticmethod
+    def create_driver():
+        """Starts a new headless Chrome session"""
+        options = webdriver.ChromeOptions()
+        options.add_argument('--headless')
+        options.add_argument('--window-size=1920,1080')
+        return webdriver.Chrome(options=options)
+
+
+browser_pool = BrowserPool(3)
+atexit.register(browser_pool.close)
+
+
 class PostsGetter:
-    def __init__(self, url, posts_count):
-        """Initializes Chrome webdriver, sets posts load waiting limit"""
-        self.driver = webdriver.Chrome()
+    def __init__(self, url, posts_count, pool=browser_pool):
+        """Takes browser session pool to borrow Chrome webdriver from, sets posts load waiting limit"""
+        self.pool = pool
+        self.driver = None
+        self.broken = False
         self.posts_query = ['div', {'class': '_1oQyIsiPHYt6nx7VOmd1sz'}]
         self.url = url
         self.posts_count = posts_count
         self.wait_seconds = 30
 
     def __enter__(self):
-        """Opens suggested site in browser"""
-        self.driver.get(self.url)
+        """Borrows browser session from the pool and opens suggested site in it"""
+        self.driver = self.pool.acquire()
+        try:
+            self.driver.get(self.url)
+        except Exception:
+            self.pool.release(self.driver, broken=True)
+            self.driver = None
+            raise
         return self
 
     def __exit__(self, exc_type, exc_val, exc_tb):
-        """Closes browser, suppress any exception"""
-        self.driver.quit()
+        """Returns browser session to the pool, suppress any exception.
+
+        The session which raised an exception is considered broken and closed.
+        """
+        if self.driver:
+            self.pool.release(self.driver, broken=self.broken or exc_type is not None)
+            self.driver = None
         return True
 
     def get_posts(self):
-        """After waiting for the page to be loaded, finds all the posts presented on the page"""
-        all_posts = []
+        """After waiting for the page to be loaded, finds all the posts presented on the page.
+
+        Returns empty list if the posts aren't loaded in time. If the browser session fails, it's marked
+        as broken, so it's closed instead of being returned to the pool, and empty list is returned as well.
+        """
         try:
             WebDriverWait(self.driver, self.wait_seconds).until(PageLoader(self.posts_count))
             page_text = self.driver.page_source
-            page_text_soup = BeautifulSoup(page_text, features="html.parser")
-            all_posts = page_text_soup.findAll(self.posts_query[0], self.posts_query[1])
-        finally:
-            return all_posts
+        except TimeoutException:
+            return []
+        except Exception:
+            logging.exception(f'Browser session failed, listing URL: {self.url}')
+            self.broken = True
+            return []
+        page_text_soup = BeautifulSoup(page_text, features="html.parser")
+        return page_text_soup.findAll(self.posts_query[0], self.posts_query[1])
 
 
 class ParserError(Exception):
@@ -73,29 +157,27 @@ class ParserError(Exception):
 
 
 class PostDataParser:
+    date_and_url_query = ['a', {"class": "_3jOxDPIQ0KaOWpzvSQo-1s"}]
+
     def __init__(self, post):
         """Defines queries for searching specific data in HTML, extracts post-related data from HTML and
 
-        write this data to dictionary.
+        write this data to post record.
         """
         self.category_query = ['a', {"class": "_3ryJoIoycVkA88fy40qNJc"}]
         self.comments_count_query1 = ['span', {"class": "D6SuXeSnAAagG8dKAb4O4"}]
         self.comments_count_query2 = ['span', {"class": "FHCV02u6Cp2zYL0fhQPsO"}]
-        self.date_and_url_query = ['a', {"class": "_3jOxDPIQ0KaOWpzvSQo-1s"}]
         self.karma_and_cake_day_query = ['span', {"class": "_1hNyZSklmcC7R_IfCUcXmZ"}]
         self.post_and_comment_karma_query = ['span', {"class": "karma"}]
         self.votes_count_query = ['div', {"class": "_1rZYMD_4xY3gRcSS3p8ODO"}]
         self.username_query = ['a', {"class": "_2tbHP6ZydRpjI44J3syuqC"}]
         self.post = str(post)
         self.post_soup = BeautifulSoup(self.post, features="html.parser")
-        self.post_dict = {}
         self.unique_id = uuid.uuid1().hex
         self.methods_order = ['define_url_date', 'define_username_karmas_cakeday', 'define_comments_count',
                               'define_votes_count', 'define_category']
-        self.dict_order = ['unique_id', 'post_url', 'username', 'user_karma', 'user_cake_day', 'post_karma',
-                           'comment_karma', 'post_date', 'comments_count', 'votes_count', 'post_category']
         self.extract_data()
-        self.make_post_dict()
+        self.post_record = self.make_post_record()
 
     def extract_data(self):
         """Calls class methods according to a certain order"""
@@ -161,10 +243,16 @@ class PostDataParser:
         category_tag = self.post_soup.findAll(self.category_query[0], self.category_query[1])[1]
         self.post_category = category_tag.text[2:]
 
-    def make_post_dict(self):
-        """Writes previously generated post-related data to dictionary according to a certain order"""
-        for attr_name in self.dict_order:
-            self.post_dict[attr_name] = getattr(self, attr_name)
+    @classmethod
+    def find_post_url(cls, post):
+        """Defines post URL without parsing the rest of post data. Returns None if the URL isn't found"""
+        date_and_url_tag = post.find(cls.date_and_url_query[0], cls.date_and_url_query[1])
+        if date_and_url_tag:
+            return date_and_url_tag.attrs.get("href")
+
+    def make_post_record(self):
+        """Makes post record from previously generated post-related data"""
+        return Post(*(getattr(self, attr_name) for attr_name in Post.__slots__))
 
     @staticmethod
     def get_html(url):
@@ -190,7 +278,7 @@ class FileWriter:
     def __init__(self, post_data):
         """Takes a list with collected data from all posts. Defines the path to output file,
 
-        writes stringified post data to it after having removed previous one if existing.
+        writes stringified post data to it after having removed previous parser output if existing.
         """
         self.post_data = post_data
         self.new_file_name = self.define_file_name('txt')
@@ -199,27 +287,29 @@ class FileWriter:
         self.write_data_to_new_file()
 
     def write_data_to_new_file(self):
-        """Writes post data stringified from dictionary to the new file"""
+        """Writes stringified post records to the new file"""
         with open(self.path_to_new_file, 'w') as file:
-            for ind, post_dict in enumerate(self.post_data):
-                post_data_str = DataConverter.make_str_from_dict(post_dict)
-                if ind != len(self.post_data) - 1:
-                    post_data_str += '\n'
-                file.write(post_data_str)
+            file.write(Post.dump_lines(self.post_data))
 
     def remove_old_file(self):
-        """Removes no longer needed post data file if existing"""
-        path_to_old_file = self.define_path_to_file('reddit-')
-        if path_to_old_file:
+        """Removes no longer needed post data files previously written by the parser if existing.
+
+        Day partitions of the service (reddit-YYYYMMDD.txt) are kept.
+        """
+        for path_to_old_file in self.find_parser_files():
             os.remove(path_to_old_file)
 
     @staticmethod
-    def define_path_to_file(prefix):
-        """Defines path to the file existing in the directory under the prefix contained in the file name"""
+    def find_parser_files():
+        """Returns paths to the files in the directory named as the parser output (reddit-YYYYMMDDHHMM.txt)"""
         work_dir_path = os.getcwd()
+        paths = []
         for name in os.listdir(work_dir_path):
-            if os.path.isfile(name) and prefix in name:
-                return os.path.join(work_dir_path, name)
+            datetime_str = name[len('reddit-'):-len('.txt')]
+            if name.startswith('reddit-') and name.endswith('.txt') and len(datetime_str) == 12 \
+                    and datetime_str.isdigit() and os.path.isfile(name):
+                paths.append(os.path.join(work_dir_path, name))
+        return paths
 
     @staticmethod
     def define_file_name(file_format):
@@ -230,22 +320,187 @@ class FileWriter:
         return file_name
 
 
-class PostsProcessor:
-    def __init__(self, url, posts_count):
-        """Takes URL from reddit.com and count of posts which have to be written to output file.
+class PostsPublisher:
+    def __init__(self, import_url="http://localhost:8087/import/", batch_size=500, max_wait=1.0, retries=3,
+                 retry_delay=0.5):
+        """Takes URL of the import endpoint of the service, the maximum number of posts in one batch,
 
-        Forms a list of all posts in HTML format presented on the webpage.
-        Parses these data and make a list of each post data from them.
-        Writes stringified post data to the file.
+        the maximum time in seconds a post waits in the buffer and the number of retries of a failed batch.
+        Publishes post records to the service in batches of NDJSON over one keep-alive session.
+        A batch is sent when it's full or when its first post has waited max_wait seconds.
         """
-        self.url = url
+        self.import_url = import_url
+        self.batch_size = batch_size
+        self.max_wait = max_wait
+        self.retries = retries
+        self.retry_delay = retry_delay
+        self.session = requests.Session()
+        self.buffer = []
+        self.buffer_started = None
+        self.batches_in_flight = 0
+        self.condition = threading.Condition()
+        self.send_lock = threading.Lock()
+        self.counts = {'imported': 0, 'duplicates': 0, 'invalid': 0, 'failed': 0}
+        self.sent_count = 0
+        self.send_seconds = 0
+        self.closed = False
+        self.flusher = threading.Thread(target=self.flush_on_time, name='posts-publisher', daemon=True)
+        self.flusher.start()
+
+    def __call__(self, posts):
+        """Publishes the list of post records and waits until they are sent. Returns the counts of imported,
+
+        duplicate, invalid and failed posts. Allows the publisher to be used as writer of PostsProcessor.
+        """
+        for post in posts:
+            self.add(post)
+        self.flush()
+        return dict(self.counts)
+
+    def __enter__(self):
+        """Returns the publisher itself"""
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        """Sends the rest of buffered posts and closes the publisher"""
+        self.close()
+
+    def add(self, post):
+        """Puts post record into the buffer, sends the buffered batch if it's full"""
+        with self.condition:
+            if not self.buffer:
+                self.buffer_started = time.monotonic()
+                self.condition.notify()
+            self.buffer.append(post)
+            if len(self.buffer) < self.batch_size:
+                return
+            batch = self.take_batch()
+        self.send_batch(batch)
+
+    def flush(self):
+        """Sends all the buffered posts and waits until the batches taken from the buffer earlier are sent as well"""
+        with self.condition:
+            batch = self.take_batch()
+        if batch:
+            self.send_batch(batch)
+        with self.condition:
+            self.condition.wait_for(lambda: not self.batches_in_flight)
+
+    def close(self):
+        """Sends the rest of buffered posts, stops the flushing thread, closes the session and logs throughput"""
+        with self.condition:
+            self.closed = True
+            self.condition.notify()
+        self.flusher.join()
+        self.flush()
+        self.session.close()
+        logging.info(f'Posts published, {self.describe_throughput()}')
+
+    def take_batch(self):
+        """Empties the buffer and returns its posts, has to be called holding the condition.
+
+        Non-empty batch is counted as in flight until send_batch finishes sending it.
+        """
+        batch = self.buffer
+        self.buffer = []
+        self.buffer_started = None
+        if batch:
+            self.batches_in_flight += 1
+        return batch
+
+    def flush_on_time(self):
+        """Sends the buffered batch when its first post has waited max_wait seconds. Runs until the publisher closes"""
+        while True:
+            with self.condition:
+                while not self.closed and (self.buffer_started is None
+                                           or time.monotonic() - self.buffer_started < self.max_wait):
+                    timeout = None if self.buffer_started is None else \
+                        self.buffer_started + self.max_wait - time.monotonic()
+                    self.condition.wait(timeout)
+                if self.closed:
+                    return
+                batch = self.take_batch()
+            self.send_batch(batch)
+
+    def send_batch(self, batch):
+        """Sends the batch of posts to the service. Connection errors, timeouts and server errors are retried
+
+        with growing delays, if all the attempts fail, the posts are counted as failed and the error is logged.
+        Wakes up the threads waiting for the batches in flight when done.
+        """
+        try:
+            self.post_batch(batch)
+        finally:
+            with self.condition:
+                self.batches_in_flight -= 1
+                self.condition.notify_all()
+
+    def post_batch(self, batch):
+        """Posts the batch to the import endpoint with retries, updates the counts of published posts"""
+        body = b''.join(post.to_json() + b'\n' for post in batch)
+        with self.send_lock:
+            started = time.monotonic()
+            for attempt in range(self.retries + 1):
+                if attempt:
+                    time.sleep(self.retry_delay * 2 ** (attempt - 1))
+                try:
+                    response = self.session.post(self.import_url, data=body, timeout=30,
+                                                 headers={'Content-Type': 'application/x-ndjson'})
+                except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as err:
+                    error = f'{type(err).__name__}: {err}'
+                    continue
+                if response.status_code < 500:
+                    break
+                error = f'status code {response.status_code}'
+            else:
+                response = None
+            self.send_seconds += time.monotonic() - started
+            self.sent_count += len(batch)
+            if response is not None and response.status_code == 200:
+                for name, count in response.json().items():
+                    self.counts[name] = self.counts.get(name, 0) + count
+            else:
+                self.counts['failed'] += len(batch)
+                if response is not None:
+                    error = f'status code {response.status_code}'
+                logging.error(f'Batch of {len(batch)} posts is not published, {error}')
+                return
+            logging.info(f'Batch of {len(batch)} posts published, {self.describe_throughput()}')
+
+    def describe_throughput(self):
+        """Describes the counts of published posts and the rate of sending them"""
+        rate = self.sent_count / self.send_seconds if self.send_seconds else 0
+        counts = ', '.join(f'{name}: {count}' for name, count in self.counts.items())
+        return f'{counts}, {rate:.0f} posts/s'
+
+
+class PostsProcessor:
+    def __init__(self, urls, posts_count, pool=browser_pool, writer=FileWriter, progress=None):
+        """Takes listing URL or list of listing URLs from reddit.com and count of posts which have to be written
+
+        to output file. Forms a list of all posts in HTML format presented on the webpages, the listings are
+        scraped concurrently by browser sessions borrowed from the pool. Posts repeated in several listings
+        are left only once. Parses these data and make a list of each post data from them.
+        Passes the list of post records to the writer, by default stringified post data is written to the file.
+        If progress callback is given, it's called with the current stage, count of processed and total items.
+        """
+        self.urls = [urls] if isinstance(urls, str) else list(urls)
         self.posts_count = posts_count
-        self.all_posts = self.get_posts_list(self.url, self.posts_count)
+        self.pool = pool
+        self.progress = progress
+        self.all_posts = self.get_posts_list(self.urls, self.posts_count)
         self.parsed_post_data = self.establish_post_data()
-        FileWriter(self.parsed_post_data)
+        self.report_progress('writing posts', 0, len(self.parsed_post_data))
+        writer(self.parsed_post_data)
+        self.report_progress('writing posts', len(self.parsed_post_data), len(self.parsed_post_data))
+
+    def report_progress(self, stage, done, total):
+        """Passes the current stage and the count of processed items to progress callback if it's given"""
+        if self.progress:
+            self.progress(stage, done, total)
 
-    def get_posts_list(self, url, posts_count):
-        """Tries to find posts on indicated URL in the amount by a factor
+    def get_posts_list(self, urls, posts_count):
+        """Tries to find posts on each indicated URL in the amount by a factor
 
         of 1.5 times exceeding required to be written to the file.
         Does basic configuration for the logging system,
@@ -254,28 +509,70 @@ class PostsProcessor:
         logging.basicConfig(filename="parserLogs.log", level=logging.INFO,
                             format='%(asctime)s. %(levelname)s: %(message)s')
         logging.info('Start sending requests')
-        with PostsGetter(url, posts_count) as pg:
-            return pg.get_posts()
+        listings = []
+        self.report_progress('loading listings', 0, len(urls))
+        with ThreadPoolExecutor(max_workers=min(len(urls), self.pool.size) or 1) as executor:
+            for posts in executor.map(lambda url: self.get_listing_posts(url, posts_count), urls):
+                listings.append(posts)
+                self.report_progress('loading listings', len(listings), len(urls))
+        return self.deduplicate_posts(listings)
+
+    def get_listing_posts(self, url, posts_count):
+        """Finds posts on one listing page using browser session from the pool.
+
+        If the listing can't be opened, logs the error and returns empty list, so other listings are still used.
+        """
+        try:
+            with PostsGetter(url, posts_count, self.pool) as pg:
+                posts = pg.get_posts()
+                logging.info(f'{len(posts)} posts found, listing URL: {url}')
+                return posts
+        except Exception:
+            logging.exception(f'Listing is not loaded, listing URL: {url}')
+            return []
+        logging.error(f'Listing is not loaded, listing URL: {url}')
+        return []
+
+    @staticmethod
+    def deduplicate_posts(listings):
+        """Merges posts from all listings keeping the first occurrence of each post URL"""
+        unique_posts = []
+        seen_urls = set()
+        for posts in listings:
+            for post in posts:
+                post_url = PostDataParser.find_post_url(post)
+                if post_url:
+                    if post_url in seen_urls:
+                        continue
+                    seen_urls.add(post_url)
+                unique_posts.append(post)
+        return unique_posts
 
     def establish_post_data(self):
-        """Parses HTML format posts into dictionaries and adds them to list.
+        """Parses HTML format posts into post records and adds them to list.
 
         If the count of added posts is equal to needed, stop parsing.
         Logs Parser errors and information about finishing of sending requests.
         """
         parsed_post_data = []
+        self.report_progress('parsing posts', 0, self.posts_count)
         for post in self.all_posts:
             if len(parsed_post_data) == self.posts_count:
                 break
             try:
-                post_dict = PostDataParser(post).post_dict
+                post_record = PostDataParser(post).post_record
             except ParserError as err:
                 logging.error(f'{err.text}, post URL: {err.post_url}')
                 continue
-            parsed_post_data.append(post_dict)
+            parsed_post_data.append(post_record)
+            self.report_progress('parsing posts', len(parsed_post_data), self.posts_count)
         logging.info('Stop sending requests')
         return parsed_post_data
 
 
 if __name__ == "__main__":
-    PostsProcessor("https://www.reddit.com/top/?t=month", 100)
+    if '--publish' in sys.argv:
+        with PostsPublisher() as publisher:
+            PostsProcessor(["https://www.reddit.com/top/?t=month"], 100, writer=publisher)
+    else:
+        PostsProcessor(["https://www.reddit.com/top/?t=month"], 100)
@@ -1,28 +1,177 @@
-from api import add_line, change_line, del_line, get_line, get_posts
-from http.server import BaseHTTPRequestHandler, HTTPServer
+from api import add_job, add_line, change_line, del_line, export_posts, get_changes, get_job, get_jobs, get_line
+from api import get_posts, import_posts, stream_changes
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from store import post_store
+from urllib.parse import parse_qs
 from utils import parse_url
+import argparse
+import codecs
+import multiprocessing
+import signal
+import socket
+
+BODY_BLOCK_SIZE = 64 * 1024
 
 
 class Server(BaseHTTPRequestHandler):
-    def respond_to_request(self, status_code, content_type, content):
-        """Sends response comprising specified status code and content to a request"""
+    protocol_version = "HTTP/1.1"
+
+    def respond_to_request(self, status_code, content_type, content, headers=None):
+        """Sends response comprising specified status code, content and additional headers to a request.
+
+        Content can be given as a string or as already encoded bytes.
+        """
+        if isinstance(content, str):
+            content = bytes(content, "utf-8")
+        self.send_response(status_code)
+        self.send_header("Content-type", content_type)
+        self.send_header("Content-Length", str(len(content)))
+        for header_name, header_value in (headers or {}).items():
+            self.send_header(header_name, header_value)
+        self.end_headers()
+        self.wfile.write(content)
+
+    def respond_with_stream(self, status_code, content_type, chunks):
+        """Sends response comprising specified status code and the content which is written chunk by chunk
+
+        as the chunks are generated. The connection is closed at the end of the content or when the client
+        disconnects.
+        """
+        self.close_connection = True
+        self.send_response(status_code)
+        self.send_header("Content-type", content_type)
+        self.send_header("Cache-Control", "no-cache")
+        self.send_header("Connection", "close")
+        self.end_headers()
+        try:
+            for chunk in chunks:
+                self.wfile.write(chunk)
+                self.wfile.flush()
+        except (BrokenPipeError, ConnectionResetError):
+            ...
+
+    def respond_with_chunks(self, status_code, content_type, chunks):
+        """Sends response comprising specified status code and the content which is written using chunked
+
+        transfer encoding as the chunks are generated, so the connection can be kept alive.
+        """
         self.send_response(status_code)
         self.send_header("Content-type", content_type)
+        self.send_header("Transfer-Encoding", "chunked")
         self.end_headers()
-        self.wfile.write(bytes(content, "utf-8"))
+        try:
+            for chunk in chunks:
+                if chunk:
+                    self.wfile.write(b'%x\r\n%s\r\n' % (len(chunk), chunk))
+            self.wfile.write(b'0\r\n\r\n')
+        except (BrokenPipeError, ConnectionResetError):
+            self.close_connection = True
+
+    def read_body(self):
+        """Reads the whole request body"""
+        return b''.join(self.read_body_blocks())
+
+    def read_body_blocks(self):
+        """Yields the request body in blocks of at most 64 KB. The body can be sent with Content-Length
+
+        or using chunked transfer encoding.
+        """
+        if self.headers.get('Transfer-Encoding', '').lower() == 'chunked':
+            while True:
+                chunk_size = int(self.rfile.readline().split(b';')[0], 16)
+                if not chunk_size:
+                    while self.rfile.readline() not in (b'\r\n', b'\n', b''):
+                        ...
+                    return
+                while chunk_size:
+                    block = self.rfile.read(min(chunk_size, BODY_BLOCK_SIZE))
+                    if not block:
+                        raise ConnectionResetError('request body is truncated')
+                    chunk_size -= len(block)
+                    yield block
+                self.rfile.readline()
+        else:
+            body_size = int(self.headers.get('Content-Length') or 0)
+            while body_size:
+                block = self.rfile.read(min(body_size, BODY_BLOCK_SIZE))
+                if not block:
+                    raise ConnectionResetError('request body is truncated')
+                body_size -= len(block)
+                yield block
+
+    def read_body_lines(self):
+        """Yields lines of the request body decoded from UTF-8 as the body is received, line endings are kept"""
+        decoder = codecs.getincrementaldecoder('utf-8')('replace')
+        tail = ''
+        for block in self.read_body_blocks():
+            lines = (tail + decoder.decode(block)).split('\n')
+            tail = lines.pop()
+            for line in lines:
+                yield line + '\n'
+        tail += decoder.decode(b'', final=True)
+        if tail:
+            yield tail
+
+    def get_transfer_format(self, query):
+        """Returns the format of exported or imported posts given in query "?format=ndjson|csv",
+
+        for requests having a body the format can also be defined by Content-Type. NDJSON is used by default.
+        """
+        transfer_format = parse_qs(query).get('format', [None])[0]
+        if transfer_format:
+            return transfer_format
+        return 'csv' if self.headers.get('Content-Type', '').startswith('text/csv') else 'ndjson'
 
     def do_GET(self):
         """Calls corresponding function for handling a GET request depending on the result of URL parsing
 
         and determines the necessary data for respond to a request.
         If URL is equal to "http://localhost:8087/posts/" - data will be received from function get_posts,
+        the posts can be filtered by post date with query "?from=DD.MM.YYYY&to=DD.MM.YYYY",
         if matches "http://localhost:8087/posts/<UNIQUE_ID>/" - from get_line.
+        If URL is equal to "http://localhost:8087/posts/changes?since=<seq>" - from get_changes or,
+        if Server-Sent Events are accepted by the client, the changes are streamed from stream_changes.
+        If URL is equal to "http://localhost:8087/jobs/" - from get_jobs,
+        if matches "http://localhost:8087/jobs/<JOB_ID>/" - from get_job.
+        If URL is equal to "http://localhost:8087/export/?format=ndjson|csv", all the posts are streamed
+        in chunks from export_posts.
         If URL is equal to "http://localhost:8087/", data needed for displaying the main page will be used.
         If URL is incorrect, status code 404 will be used in response.
         Sends response comprising defined data to the request.
         """
-        url = self.path[1:]
-        if url:
+        url, _, query = self.path[1:].partition('?')
+        headers = None
+        if url.rstrip('/') == 'export':
+            response = export_posts(self.get_transfer_format(query))
+            if response['status_code'] == 200:
+                self.respond_with_chunks(200, response['content_type'], response['content'])
+            else:
+                self.respond_to_request(response['status_code'], "application/json", '')
+            return
+        if url[:4] == 'jobs':
+            id = parse_url(url, 'jobs')
+            if id == 404:
+                response = {'status_code': 404}
+            elif id:
+                response = get_job(id)
+            else:
+                response = get_jobs()
+            self.respond_to_request(response['status_code'], "application/json", response.get('content', ''))
+            return
+        if url.rstrip('/') == 'posts/changes':
+            params = parse_qs(query)
+            since = params.get('since', [self.headers.get('Last-Event-ID')])[0]
+            if 'text/event-stream' in self.headers.get('Accept', ''):
+                response = stream_changes(since)
+                if response['status_code'] == 200:
+                    self.respond_with_stream(200, "text/event-stream", response['content'])
+                    return
+            else:
+                response = get_changes(since, params.get('timeout', [None])[0])
+            status_code = response['status_code']
+            content_type = "application/json"
+            content = response.get('content', '')
+        elif url:
             response = {}
             id = parse_url(url)
             if id == 404:
@@ -31,32 +180,44 @@ class Server(BaseHTTPRequestHandler):
                 response = get_line(id)
                 status_code = response['status_code']
             else:
-                response = get_posts()
+                params = parse_qs(query)
+                response = get_posts(params.get('from', [None])[0], params.get('to', [None])[0])
                 status_code = response['status_code']
             content_type = "application/json"
             content = response.get('content', '')
+            headers = response.get('headers')
         else:
             content_type = "text/html"
             content = "<h1>Server</h1>"
             status_code = 200
-        self.respond_to_request(status_code, content_type, content)
+        self.respond_to_request(status_code, content_type, content, headers)
 
     def do_POST(self):
         """Determines the necessary data for respond to a POST request.
 
-        If URL is equal to "http://localhost:8087/posts/", receives these data from function add_line.
+        If URL is equal to "http://localhost:8087/posts/", receives these data from function add_line,
+        if URL is equal to "http://localhost:8087/jobs/" - from add_job.
+        If URL is equal to "http://localhost:8087/import/?format=ndjson|csv", the posts are read from the body
+        as it's received and added by import_posts.
         If URL is incorrect, status code 404 will be used in response.
         Sends response comprising defined data to the request.
         """
-        url = self.path
+        url, _, query = self.path.partition('?')
         content_type = "application/json"
-        if url == "/posts/":
-            content_length = int(self.headers['Content-Length'])
-            post_body = self.rfile.read(content_length)
-            response = add_line(post_body)
+        if url.rstrip('/') == "/import":
+            body_lines = self.read_body_lines()
+            response = import_posts(body_lines, self.get_transfer_format(query))
+            for _ in body_lines:
+                ...
+            content = response.get('content', '')
+            status_code = response['status_code']
+        elif url in ("/posts/", "/jobs/"):
+            post_body = self.read_body()
+            response = add_line(post_body) if url == "/posts/" else add_job(post_body)
             content = response.get('content', '')
             status_code = response['status_code']
         else:
+            self.read_body()
             content = ''
             status_code = 404
         self.respond_to_request(status_code, content_type, content)
@@ -87,28 +248,100 @@ class Server(BaseHTTPRequestHandler):
         Sends response comprising defined data to the request.
         """
         url = self.path[1:]
+        put_body = self.read_body()
         content_type = "application/json"
         content = ''
         status_code = 404
         if url:
             id = parse_url(url)
             if id and id != 404:
-                content_length = int(self.headers['Content-Length'])
-                put_body = self.rfile.read(content_length)
                 response = change_line(id, put_body)
                 status_code = response['status_code']
         self.respond_to_request(status_code, content_type, content)
 
 
-def run_server(host_name, host_port):
-    """Runs the server at a time until shutdown. Pressing buttons on the keyboard will not stop the server"""
-    server = HTTPServer((host_name, host_port), Server)
-    print(f"Server Starts - {host_name}:{host_port}")
+class ThreadedServer(ThreadingHTTPServer):
+    """HTTP server handling each request in a separate thread, with a listen queue fitting concurrent clients.
+
+    If reuse_port is true, several processes can listen on the same port and the kernel spreads connections
+    between them.
+    """
+    request_queue_size = 128
+
+    def __init__(self, server_address, handler_class, reuse_port=False):
+        self.reuse_port = reuse_port
+        super().__init__(server_address, handler_class)
+
+    def server_bind(self):
+        """Binds the socket to the server address allowing other processes to bind to it if reuse_port is true"""
+        if self.reuse_port:
+            self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        super().server_bind()
+
+
+def run_server(host_name, host_port, durable=False, batch_size=64, max_wait=0.005, changes_log_size=10000,
+               workers=1):
+    """Runs the server at a time until shutdown. Pressing buttons on the keyboard will not stop the server.
+
+    Each request is handled in a separate thread. In durable mode changes of reddit-file are fsynced and
+    concurrent changes are committed in batches of at most batch_size changes collected during max_wait seconds.
+    Change feed keeps changes_log_size last changes.
+    If workers is greater than 1, the server is run in the given number of worker processes listening on the same
+    port. The workers share reddit-files: changes are serialized by the lock file, and each worker picks up
+    the changes of the others on its next read. Change feed and background jobs are disabled
+    in this mode.
+    """
+    if workers <= 1:
+        serve(host_name, host_port, durable, batch_size, max_wait, changes_log_size)
+        return
+    args = (host_name, host_port, durable, batch_size, max_wait, changes_log_size, True)
+    processes = [multiprocessing.Process(target=serve, args=args, name=f'server-worker-{number}')
+                 for number in range(workers)]
+    for process in processes:
+        process.start()
+    print(f"Server Starts - {host_name}:{host_port}, workers: {workers}")
+    signal.signal(signal.SIGTERM, signal.default_int_handler)
+    try:
+        for process in processes:
+            process.join()
+    except KeyboardInterrupt:
+        for process in processes:
+            process.terminate()
+            process.join()
+
+
+def serve(host_name, host_port, durable, batch_size, max_wait, changes_log_size, shared=False):
+    """Runs the server in the current process until shutdown. If shared is true, the port and reddit-files
+
+    are shared with other worker processes. Then the change feed and background jobs are disabled: sequence numbers
+    and jobs would be known to one worker only.
+    """
+    post_store.configure_sharing(shared)
+    post_store.configure_feed(None if shared else changes_log_size)
+    post_store.configure_durability(durable, batch_size, max_wait)
+    server = ThreadedServer((host_name, host_port), Server, shared)
+    if not shared:
+        print(f"Server Starts - {host_name}:{host_port}")
     try:
         server.serve_forever()
     except KeyboardInterrupt:
         ...
+    finally:
+        post_store.configure_durability(False)
+
+
+def parse_args():
+    """Parses command line arguments of the server"""
+    parser = argparse.ArgumentParser(description='RESTful service for reddit posts')
+    parser.add_argument('--durable', action='store_true', help='fsync changes, group concurrent changes in batches')
+    parser.add_argument('--batch-size', type=int, default=64, help='maximum number of changes in one batch')
+    parser.add_argument('--max-wait-ms', type=float, default=5, help='maximum time of collecting one batch')
+    parser.add_argument('--changes-log-size', type=int, default=10000, help='number of changes kept in change feed')
+    parser.add_argument('--workers', type=int, default=1, help='number of worker processes sharing the port')
+    return parser.parse_args()
 
 
 if __name__ == "__main__":
-    run_server("localhost", 8087)
+    args = parse_args()
+    run_server("localhost", 8087, args.durable, args.batch_size, args.max_wait_ms / 1000, args.changes_log_size,
+               args.workers)
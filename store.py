@@ -0,0 +1,706 @@
+from changes import ChangeFeed
+from utils import make_date_key, Post
+import contextlib
+import datetime
+import io
+import json
+import logging
+import os
+import queue
+import tempfile
+import threading
+import time
+
+
+class Partition:
+    def __init__(self, path, signature=None, manifest_entry=None):
+        """Takes path to the partition file, its modification signature and its description from the manifest.
+
+        Records count and the range of post dates are taken from the manifest if it describes the same version
+        of the file, otherwise they are defined by scanning the file. Post records are loaded on demand.
+        """
+        self.path = path
+        self.name = os.path.basename(path)
+        self.signature = signature
+        self.count = 0
+        self.min_date = None
+        self.max_date = None
+        self.posts = None
+        self.fragments = None
+        self.positions = None
+        self.ids = None
+        self.block = None
+        self.saved_count = 0
+        self.dirty = False
+        self.rewrite_needed = False
+        if signature is None:
+            return
+        if manifest_entry and tuple(manifest_entry['signature']) == signature:
+            self.count = manifest_entry['count']
+            self.min_date = manifest_entry['min_date']
+            self.max_date = manifest_entry['max_date']
+        else:
+            self.scan()
+
+    def read_lines(self):
+        """Reads the lines from the partition file. Malformed lines are skipped and logged.
+
+        If the file is the version described by the signature, only its size given in the signature is read,
+        so lines being appended at the moment aren't seen.
+        """
+        if self.signature is None:
+            return []
+        with open(self.path, 'rb') as file:
+            same_file = os.fstat(file.fileno()).st_ino == self.signature[0]
+            content = file.read(self.signature[2] if same_file else -1)
+        lines = io.TextIOWrapper(io.BytesIO(content)).read().splitlines()
+        valid_lines = [line for line in lines if Post.is_line_valid(line)]
+        if len(valid_lines) != len(lines):
+            logging.warning(f'Malformed lines skipped: {len(lines) - len(valid_lines)}, partition: {self.name}')
+        return valid_lines
+
+    def scan(self):
+        """Defines records count and the range of post dates without converting lines to post records"""
+        lines = self.read_lines()
+        date_keys = []
+        for line in lines:
+            values = line.split(';', 8)
+            if len(values) > 8:
+                date_keys.append(make_date_key(values[7]))
+        self.set_stats(len(lines), date_keys)
+
+    def set_stats(self, count, date_keys):
+        """Remembers records count and the range of post dates"""
+        date_keys = [date_key for date_key in date_keys if date_key]
+        self.count = count
+        self.min_date = min(date_keys, default=None)
+        self.max_date = max(date_keys, default=None)
+
+    def load(self):
+        """Converts the lines of the partition file to post records and encodes each of them to JSON"""
+        if self.posts is None:
+            self.posts = Post.parse_lines(self.read_lines())
+            self.fragments = [post.to_json() for post in self.posts]
+            self.rebuild_positions()
+            self.saved_count = len(self.posts)
+            self.block = None
+
+    def rebuild_positions(self):
+        """Maps each post unique id to the index of its line in the partition"""
+        self.positions = {post.unique_id: ind for ind, post in enumerate(self.posts)}
+
+    def get_ids(self):
+        """Returns unique ids of all the posts from the partition without loading post records.
+
+        Unique ids read from the file of not loaded partition are remembered.
+        """
+        if self.posts is not None:
+            return list(self.positions)
+        if self.ids is None:
+            self.ids = [line[:32] for line in self.read_lines()]
+        return self.ids
+
+    def get_known_ids(self):
+        """Returns unique ids of the posts from the partition if they are known without reading the file,
+
+        otherwise returns None.
+        """
+        if self.posts is not None:
+            return list(self.positions)
+        return self.ids
+
+    def overlaps(self, date_from, date_to):
+        """Defines whether any post date of the partition may be in the range from date_from to date_to"""
+        return self.min_date is not None and self.min_date <= date_to and self.max_date >= date_from
+
+    def get(self, id):
+        """Returns post record with specified unique id"""
+        self.load()
+        return self.posts[self.positions[id]]
+
+    def dump(self):
+        """Returns cached JSON of all the partition posts separated by commas"""
+        self.load()
+        if self.block is None:
+            self.block = b', '.join(self.fragments)
+        return self.block
+
+    def dump_line(self, id):
+        """Returns cached JSON of the post with specified unique id"""
+        self.load()
+        return self.fragments[self.positions[id]]
+
+    def dump_range(self, date_from, date_to):
+        """Returns list of cached JSON of the posts published from date_from to date_to"""
+        self.load()
+        fragments = []
+        for post, fragment in zip(self.posts, self.fragments):
+            date_key = make_date_key(post.post_date)
+            if date_key and date_from <= date_key <= date_to:
+                fragments.append(fragment)
+        return fragments
+
+    def append(self, post):
+        """Adds new post to the end of the partition"""
+        self.load()
+        self.posts.append(post)
+        self.fragments.append(post.to_json())
+        self.positions[post.unique_id] = len(self.posts) - 1
+        self.mark_changed()
+
+    def delete(self, id):
+        """Removes the post with specified unique id from the partition"""
+        self.load()
+        line_index = self.positions[id]
+        del self.posts[line_index]
+        del self.fragments[line_index]
+        self.rebuild_positions()
+        self.rewrite_needed = True
+        self.mark_changed()
+
+    def replace(self, id, post):
+        """Replaces the post with specified unique id by the new one"""
+        self.load()
+        line_index = self.positions.pop(id)
+        self.posts[line_index] = post
+        self.fragments[line_index] = post.to_json()
+        self.positions[post.unique_id] = line_index
+        self.rewrite_needed = True
+        self.mark_changed()
+
+    def mark_changed(self):
+        """Drops cached JSON of the whole partition, updates records count and marks the partition as uncommitted"""
+        self.block = None
+        self.count = len(self.posts)
+        self.dirty = True
+
+    def save(self, durable=False):
+        """Writes the cached posts to the partition file, updates the range of post dates and file signature.
+
+        If posts have only been added since the last save, just the new posts are appended to the file,
+        otherwise the file is rewritten.
+        """
+        if self.rewrite_needed or self.signature is None:
+            write_file(self.path, Post.dump_lines(self.posts), durable)
+            self.set_stats(len(self.posts), [make_date_key(post.post_date) for post in self.posts])
+        else:
+            new_posts = self.posts[self.saved_count:]
+            append_file(self.path, Post.dump_lines(new_posts), durable)
+            self.set_stats(len(self.posts), [self.min_date, self.max_date] +
+                           [make_date_key(post.post_date) for post in new_posts])
+        self.signature = get_signature(self.path)
+        self.saved_count = len(self.posts)
+        self.dirty = False
+        self.rewrite_needed = False
+
+    def make_manifest_entry(self):
+        """Describes the partition for the manifest"""
+        return {'name': self.name, 'count': self.count, 'min_date': self.min_date, 'max_date': self.max_date,
+                'signature': list(self.signature)}
+
+
+class PostStore:
+    partition_prefix = 'reddit-'
+    partition_extension = '.txt'
+    manifest_name = 'posts-manifest.json'
+    lock_file_name = '.posts.lock'
+
+    def __init__(self, dir_path=None):
+        """Keeps the posts of reddit-files located in dir_path (current working directory by default) in memory.
+
+        Posts are partitioned by post date: each day is stored in its own reddit-YYYYMMDD.txt file, files of
+        another naming (e.g. written by the parser) are used as partitions as well. The manifest keeps records
+        count and the range of post dates of each partition, so only the partitions relevant to a query are loaded.
+        Every loaded post is kept as a post record together with its JSON. Changes of the files made outside
+        of the store are picked up on the next refresh. All the reads and changes of the store have to be done
+        while holding the store lock; changes are written to the files by commit and then published to the feed
+        unless the feed is disabled.
+        """
+        self.dir_path = dir_path
+        self.current_dir_path = None
+        self.partitions = {}
+        self.index = None
+        self.lock = threading.RLock()
+        self.process_lock = contextlib.nullcontext()
+        self.process_read_lock = contextlib.nullcontext()
+        self.shared = False
+        self.committer = None
+        self.feed = ChangeFeed()
+        self.uncommitted_changes = []
+
+    def configure_durability(self, durable, batch_size=64, max_wait=0.005):
+        """Switches durable mode on or off. In durable mode every commit is fsynced and concurrent changes
+
+        are grouped into batches of at most batch_size changes collected during no more than max_wait seconds.
+        """
+        if self.committer:
+            self.committer.stop()
+            self.committer = None
+        if durable:
+            self.committer = GroupCommitter(self, batch_size, max_wait)
+
+    def configure_sharing(self, shared):
+        """Switches sharing of the files with other processes on or off. While the files are shared,
+
+        changes are applied and committed holding an exclusive lock of the lock file, and the store is refreshed
+        under this lock, so each change is applied on top of the changes committed by other processes.
+        Reads have to hold process read lock (a shared lock of the same file) together with the store lock,
+        so a commit of another process changing several partitions is never seen half-applied.
+        """
+        self.shared = shared
+        self.process_lock = FileLock(self.get_lock_file_path) if shared else contextlib.nullcontext()
+        self.process_read_lock = FileLock(self.get_lock_file_path, True) if shared else contextlib.nullcontext()
+
+    def get_lock_file_path(self):
+        """Returns path to the lock file which serializes changes of processes sharing the files"""
+        return os.path.join(self.dir_path or os.getcwd(), self.lock_file_name)
+
+    def configure_feed(self, capacity):
+        """Sets the number of the last changes kept in the change feed. If capacity is None, the feed is disabled"""
+        self.feed = ChangeFeed(capacity) if capacity is not None else None
+
+    def execute(self, change):
+        """Applies the change function to the store and waits until its result is written to the files.
+
+        Returns the result of the change function.
+        """
+        if self.committer:
+            return self.committer.submit(change)
+        with self.lock, self.process_lock:
+            try:
+                result = change()
+                self.commit()
+            except Exception:
+                self.invalidate()
+                raise
+        return result
+
+    def refresh(self):
+        """Picks up partition files which have been added, removed or modified since the last refresh.
+
+        Does nothing while there are uncommitted changes.
+        """
+        if self.is_dirty():
+            return
+        dir_path = self.dir_path or os.getcwd()
+        if dir_path != self.current_dir_path:
+            self.current_dir_path = dir_path
+            self.partitions = {}
+            self.index = None
+        manifest = None
+        found_names = set()
+        replaced_partitions = []
+        for name in os.listdir(dir_path):
+            if not self.is_partition_name(name):
+                continue
+            path = os.path.join(dir_path, name)
+            try:
+                signature = get_signature(path)
+            except FileNotFoundError:
+                continue
+            found_names.add(name)
+            partition = self.partitions.get(name)
+            if partition and partition.signature == signature:
+                continue
+            if manifest is None:
+                manifest = self.read_manifest()
+            self.partitions[name] = Partition(path, signature, manifest.get(name))
+            replaced_partitions.append((partition, self.partitions[name]))
+        for name in list(self.partitions):
+            if name not in found_names:
+                replaced_partitions.append((self.partitions.pop(name), None))
+        if replaced_partitions:
+            if self.index is not None:
+                self.update_index(replaced_partitions)
+            self.write_manifest()
+
+    def update_index(self, replaced_partitions):
+        """Takes list of tuples (old partition or None, new partition or None) describing the partitions whose
+
+        files have been added, modified or removed. Replaces the index entries of the old partitions by
+        the entries of the new ones, so only the changed files are read.
+        """
+        for old_partition, _ in replaced_partitions:
+            if old_partition is None:
+                continue
+            ids = old_partition.get_known_ids()
+            if ids is None:
+                ids = [id for id, partition in self.index.items() if partition is old_partition]
+            for id in ids:
+                if self.index.get(id) is old_partition:
+                    del self.index[id]
+        for _, new_partition in replaced_partitions:
+            if new_partition is not None:
+                for id in new_partition.get_ids():
+                    self.index[id] = new_partition
+
+    def invalidate(self):
+        """Drops uncommitted changes, forces the store to be reloaded from the files on the next refresh"""
+        self.partitions = {}
+        self.index = None
+        self.uncommitted_changes = []
+
+    def is_dirty(self):
+        """Defines whether the store has uncommitted changes"""
+        return any(partition.dirty for partition in self.partitions.values())
+
+    def is_partition_name(self, name):
+        """Defines whether the file with specified name is a partition file"""
+        return name.startswith(self.partition_prefix) and name.endswith(self.partition_extension)
+
+    def sorted_partitions(self):
+        """Returns partitions ordered by the date contained in their names"""
+        prefix_len = len(self.partition_prefix)
+        return sorted(self.partitions.values(), key=lambda partition: (partition.name[prefix_len:prefix_len + 8],
+                                                                       partition.name))
+
+    def get_index(self):
+        """Returns global index mapping each post unique id to its partition, builds the index if necessary"""
+        if self.index is None:
+            index = {}
+            for partition in self.sorted_partitions():
+                for id in partition.get_ids():
+                    index[id] = partition
+            self.index = index
+        return self.index
+
+    def get_target_partition(self, post):
+        """Returns partition for the new post according to its post date, creates the partition if necessary.
+
+        Posts with a post date of unknown format are written to the partition of the current day.
+        """
+        date_key = make_date_key(post.post_date) or datetime.date.today().strftime('%Y%m%d')
+        name = f'{self.partition_prefix}{date_key}{self.partition_extension}'
+        if name not in self.partitions:
+            self.partitions[name] = Partition(os.path.join(self.current_dir_path, name))
+        return self.partitions[name]
+
+    def count(self):
+        """Returns the number of posts in all the partitions"""
+        return sum(partition.count for partition in self.partitions.values())
+
+    def contains(self, id):
+        """Defines whether the post with specified unique id is stored"""
+        return id in self.get_index()
+
+    def find_stored_ids(self, ids):
+        """Returns the set of unique ids from specified ones whose posts are stored"""
+        return self.get_index().keys() & ids
+
+    def get(self, id):
+        """Returns post record with specified unique id or None if the post isn't found"""
+        partition = self.get_index().get(id)
+        if partition is None:
+            return
+        return partition.get(id)
+
+    def dump_all(self):
+        """Returns JSON array of all posts assembled from the cached JSON of each partition"""
+        blocks = [partition.dump() for partition in self.sorted_partitions() if partition.count]
+        return b'[' + b', '.join(blocks) + b']'
+
+    def dump_range(self, date_from, date_to):
+        """Returns JSON array of the posts published from date_from to date_to (YYYYMMDD strings).
+
+        Only the partitions whose range of post dates overlaps the requested one are loaded.
+        """
+        fragments = []
+        for partition in self.sorted_partitions():
+            if partition.overlaps(date_from, date_to):
+                fragments.extend(partition.dump_range(date_from, date_to))
+        return b'[' + b', '.join(fragments) + b']'
+
+    def dump_line(self, id):
+        """Returns cached JSON of the post with specified unique id or None if the post isn't found"""
+        partition = self.get_index().get(id)
+        if partition is None:
+            return
+        return partition.dump_line(id)
+
+    def iterate_posts(self):
+        """Yields tuples (post record, post JSON or None) of all stored posts partition by partition.
+
+        Has to be called without holding the store lock: the lock is taken for a moment per partition.
+        Posts of a loaded partition are copied at the moment the partition is reached; partitions which
+        aren't loaded are read from their files without loading them to the store, malformed lines are skipped.
+        """
+        with self.lock, self.process_read_lock:
+            self.refresh()
+            partitions = self.sorted_partitions()
+        for partition in partitions:
+            with self.lock:
+                if partition.posts is not None:
+                    items = list(zip(partition.posts, partition.fragments))
+                else:
+                    items = None
+            if items is not None:
+                yield from items
+                continue
+            try:
+                with self.process_read_lock:
+                    lines = partition.read_lines()
+            except FileNotFoundError:
+                continue
+            for line in lines:
+                yield Post.from_line(line), None
+
+    def append(self, post):
+        """Adds new post to the partition of its post date. Returns the number of stored posts"""
+        index = self.get_index()
+        partition = self.get_target_partition(post)
+        partition.append(post)
+        index[post.unique_id] = partition
+        self.uncommitted_changes.append(('add', post.unique_id, partition.dump_line(post.unique_id)))
+        return self.count()
+
+    def delete(self, id):
+        """Removes the post with specified unique id"""
+        partition = self.get_index().pop(id)
+        partition.delete(id)
+        self.uncommitted_changes.append(('delete', id, None))
+
+    def replace(self, id, post):
+        """Replaces the post with specified unique id by the new one. The post stays in the same partition.
+
+        If the unique id is changed, the change is published as deletion of the old post and addition of the new one.
+        """
+        index = self.get_index()
+        partition = index.pop(id)
+        partition.replace(id, post)
+        index[post.unique_id] = partition
+        fragment = partition.dump_line(post.unique_id)
+        if post.unique_id == id:
+            self.uncommitted_changes.append(('change', id, fragment))
+        else:
+            self.uncommitted_changes.extend([('delete', id, None), ('add', post.unique_id, fragment)])
+
+    def commit(self):
+        """Writes uncommitted changes to the partition files, updates the manifest and publishes the changes
+
+        to the feed. In durable mode the data is fsynced before publishing.
+        """
+        dirty_partitions = [partition for partition in self.partitions.values() if partition.dirty]
+        if not dirty_partitions:
+            return
+        durable = self.committer is not None
+        for partition in dirty_partitions:
+            partition.save(durable)
+        self.write_manifest()
+        if durable:
+            fsync_dir(self.current_dir_path)
+        if self.feed:
+            self.feed.publish(self.uncommitted_changes)
+        self.uncommitted_changes = []
+
+    def read_manifest(self):
+        """Reads the manifest. Returns dictionary mapping partition name to its description"""
+        try:
+            with open(os.path.join(self.current_dir_path, self.manifest_name)) as file:
+                manifest = json.load(file)
+            return {entry['name']: entry for entry in manifest['partitions']}
+        except (OSError, ValueError, KeyError, TypeError):
+            return {}
+
+    def write_manifest(self):
+        """Writes descriptions of all the partitions to the manifest"""
+        entries = [partition.make_manifest_entry() for partition in self.sorted_partitions()
+                   if partition.signature is not None]
+        write_file(os.path.join(self.current_dir_path, self.manifest_name), json.dumps({'partitions': entries}))
+
+
+class PendingChange:
+    def __init__(self, change):
+        """Takes change function waiting to be applied as a part of a batch"""
+        self.change = change
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class GroupCommitter:
+    def __init__(self, store, batch_size, max_wait):
+        """Starts background thread which applies queued changes to the store in batches.
+
+        Each batch is written with one write and one fsync per changed partition.
+        """
+        self.store = store
+        self.batch_size = batch_size
+        self.max_wait = max_wait
+        self.pending = queue.Queue()
+        self.thread = threading.Thread(target=self.run, name='group-committer', daemon=True)
+        self.thread.start()
+
+    def submit(self, change):
+        """Queues the change and waits until the batch containing it is durable. Returns the change result,
+
+        reraises the exception raised by the change or by writing the batch.
+        """
+        pending_change = PendingChange(change)
+        self.pending.put(pending_change)
+        pending_change.done.wait()
+        if pending_change.error:
+            raise pending_change.error
+        return pending_change.result
+
+    def stop(self):
+        """Stops background thread after the changes queued so far are committed"""
+        self.pending.put(None)
+        self.thread.join()
+
+    def run(self):
+        """Collects batches of queued changes and commits them until stopped"""
+        running = True
+        while running:
+            batch = [self.pending.get()]
+            deadline = time.monotonic() + self.max_wait
+            while len(batch) < self.batch_size and batch[-1] is not None:
+                timeout = deadline - time.monotonic()
+                try:
+                    batch.append(self.pending.get(timeout=timeout) if timeout > 0 else self.pending.get_nowait())
+                except queue.Empty:
+                    break
+            if batch[-1] is None:
+                running = False
+                batch.pop()
+            if batch:
+                self.commit_batch(batch)
+
+    def commit_batch(self, batch):
+        """Applies changes of the batch, writes them to the files at once and notifies waiting clients.
+
+        If the batch can't be applied at all (e.g. the lock file can't be opened), every change of the batch
+        gets the error, so waiting clients are always notified.
+        """
+        try:
+            self.apply_batch(batch)
+        except Exception as err:
+            with self.store.lock:
+                self.store.invalidate()
+            for pending_change in batch:
+                if pending_change.error is None:
+                    pending_change.error = err
+        finally:
+            for pending_change in batch:
+                pending_change.done.set()
+
+    def apply_batch(self, batch):
+        """Applies changes of the batch one by one and writes them to the files at once.
+
+        If a change raises an exception, the store is reloaded from the files and the rest of the batch
+        is applied again without the failed change, so no part of the failed change is committed.
+        """
+        pending_changes = list(batch)
+        with self.store.lock, self.store.process_lock:
+            while pending_changes:
+                failed_change = None
+                for pending_change in pending_changes:
+                    try:
+                        pending_change.result = pending_change.change()
+                    except Exception as err:
+                        pending_change.error = err
+                        failed_change = pending_change
+                        break
+                if failed_change:
+                    self.store.invalidate()
+                    pending_changes.remove(failed_change)
+                    continue
+                try:
+                    self.store.commit()
+                except Exception as err:
+                    self.store.invalidate()
+                    for pending_change in pending_changes:
+                        pending_change.error = err
+                break
+
+
+class FileLock:
+    def __init__(self, get_path, shared=False):
+        """Takes function returning path to the lock file. Exclusive lock of the file (or shared one if shared
+
+        is true) is held while the context is entered: exclusive lock waits for all other locks of the file,
+        shared lock waits only for exclusive ones. The lock isn't reentrant, but can be entered by several
+        threads at once, each of them opens the lock file on its own.
+        """
+        import fcntl
+        self.fcntl = fcntl
+        self.get_path = get_path
+        self.operation = fcntl.LOCK_SH if shared else fcntl.LOCK_EX
+        self.local = threading.local()
+
+    def __enter__(self):
+        """Opens the lock file, creating it if necessary, and waits for its lock"""
+        file = open(self.get_path(), 'a')
+        try:
+            self.fcntl.flock(file, self.operation)
+        except BaseException:
+            file.close()
+            raise
+        self.local.file = file
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        """Releases the lock and closes the lock file"""
+        file, self.local.file = self.local.file, None
+        try:
+            self.fcntl.flock(file, self.fcntl.LOCK_UN)
+        finally:
+            file.close()
+
+
+def write_file(file_path, content, durable=False):
+    """Writes content to a temporary file which then replaces the file, so the file is never left truncated.
+
+    If durable is true, the file content is fsynced before replacing.
+    """
+    fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(file_path), prefix='.tmp-')
+    try:
+        with open(fd, 'w') as file:
+            mode = os.stat(file_path).st_mode & 0o777 if os.path.exists(file_path) else 0o644
+            os.chmod(temp_path, mode)
+            file.write(content)
+            if durable:
+                file.flush()
+                os.fsync(file.fileno())
+        os.replace(temp_path, file_path)
+    except BaseException:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+
+
+def append_file(file_path, content, durable=False):
+    """Appends lines to the end of the file, separating them from the last line of the file by a line break.
+
+    If durable is true, the file content is fsynced.
+    """
+    if not content:
+        return
+    with open(file_path, 'rb') as file:
+        size = file.seek(0, os.SEEK_END)
+        if size:
+            file.seek(size - 1)
+            if file.read(1) != b'\n':
+                content = '\n' + content
+    with open(file_path, 'a') as file:
+        file.write(content)
+        if durable:
+            file.flush()
+            os.fsync(file.fileno())
+
+
+def fsync_dir(dir_path):
+    """Flushes directory entries to disk"""
+    dir_fd = os.open(dir_path, os.O_RDONLY)
+    try:
+        os.fsync(dir_fd)
+    finally:
+        os.close(dir_fd)
+
+
+def get_signature(file_path):
+    """Defines modification signature of the file"""
+    stat = os.stat(file_path)
+    return stat.st_ino, stat.st_mtime_ns, stat.st_size
+
+
+post_store = PostStore()
@@ -1,46 +1,57 @@
-from reddit_parser import FileWriter
+from concurrent.futures import ThreadPoolExecutor
+from reddit_parser import FileWriter, PostsPublisher
 from shutil import copy2
+from utils import Post
+import csv
+import io
 import json
 import os
 import requests
+import subprocess
+import sys
+import threading
+import time
 import unittest
 
 
 class FileReplacer:
     reddit_test_file_name = "reddit-201901191955.txt"
+    test_file_name = "test-file.txt"
+    manifest_file_name = "posts-manifest.json"
 
     def replace_reddit_by_test_file(self):
-        """Replaces reddit-file by test-file. Copies existing reddit-file to temporary while maintaining
+        """Replaces reddit-files by test-file. Renames each existing reddit-file and the manifest of reddit-files
 
-        its original name, keeping it in the name of the temporary file.
-        Removes reddit-file and copies test-file to the file with specified name.
-        If initially reddit-file didn't exist the creation of temporary file is skipped.
+        to temporary files while maintaining their original names, keeping them in the names of the temporary files.
+        Copies test-file to the file with specified name.
+        If initially reddit-files didn't exist the creation of temporary files is skipped.
         """
-        path_to_reddit_file = FileWriter.define_path_to_file('reddit-')
-        if path_to_reddit_file:
-            chars_count_to_skip = len('reddit-')
-            reddit_f_datetime_start_ind = path_to_reddit_file.rfind('reddit-') + chars_count_to_skip
-            reddit_f_datetime = path_to_reddit_file[reddit_f_datetime_start_ind:]
-            copy2(path_to_reddit_file, f'temp-{reddit_f_datetime}')
-            os.remove(path_to_reddit_file)
-        path_to_test_file = FileWriter.define_path_to_file('test-')
-        copy2(path_to_test_file, self.reddit_test_file_name)
+        chars_count_to_skip = len('reddit-')
+        for name in os.listdir(os.getcwd()):
+            if name == self.manifest_file_name:
+                os.replace(name, f'temp-{name}')
+            elif name.startswith('reddit-'):
+                os.replace(name, f'temp-{name[chars_count_to_skip:]}')
+        copy2(self.test_file_name, self.reddit_test_file_name)
 
     def restore_pre_test_state(self):
-        """Restores pre-test state of the directory. If tested file with specified name exists, removes it.
+        """Restores pre-test state of the directory. Removes reddit-files and the manifest created by the tests.
 
-        If temporary file exists, defines original name of reddit-file, copies this file to the file
-        with found name and removes temporary file.
+        If temporary files exist, defines original names of the files and renames temporary files back.
         """
-        if os.path.exists(self.reddit_test_file_name):
-            os.remove(self.reddit_test_file_name)
-        path_to_temp_file = FileWriter.define_path_to_file('temp-')
-        if path_to_temp_file:
-            chars_count_to_skip = len('temp-')
-            former_reddit_f_datetime_start_ind = path_to_temp_file.rfind('temp-') + chars_count_to_skip
-            former_reddit_f_datetime = path_to_temp_file[former_reddit_f_datetime_start_ind:]
-            copy2(path_to_temp_file, f'reddit-{former_reddit_f_datetime}')
-            os.remove(path_to_temp_file)
+        for name in os.listdir(os.getcwd()):
+            if self.is_store_file(name):
+                os.remove(name)
+        chars_count_to_skip = len('temp-')
+        for name in os.listdir(os.getcwd()):
+            if name == f'temp-{self.manifest_file_name}':
+                os.replace(name, self.manifest_file_name)
+            elif name.startswith('temp-'):
+                os.replace(name, f'reddit-{name[chars_count_to_skip:]}')
+
+    def is_store_file(self, name):
+        """Defines whether the file with specified name is reddit-file or the manifest of reddit-files"""
+        return name.startswith('reddit-') or name == self.manifest_file_name
 
 
 class DirReorganizerMixin:
@@ -77,19 +88,40 @@ class TestGET(DirReorganizerMixin, unittest.TestCase):
 
     def test_get_posts_no_file(self):
         print('testing get_posts with no file detected')
-        path_to_reddit_file = FileWriter.define_path_to_file('reddit-')
+        path_to_reddit_file = FileReplacer.reddit_test_file_name
         os.remove(path_to_reddit_file)
         req = requests.get("http://localhost:8087/posts/", timeout=5)
         self.assertEqual((req.status_code, req.content), (404, b''))
 
     def test_get_posts_empty_file(self):
         print('testing get_posts with empty file')
-        path_to_reddit_file = FileWriter.define_path_to_file('reddit-')
+        path_to_reddit_file = FileReplacer.reddit_test_file_name
         with open(path_to_reddit_file, 'w') as file:
             file.write('')
         req = requests.get("http://localhost:8087/posts/", timeout=5)
         self.assertEqual((req.status_code, req.content), (404, b''))
 
+    def test_get_posts_malformed_line(self):
+        print('testing get_posts skips malformed line')
+        with open(FileReplacer.reddit_test_file_name, 'a') as file:
+            file.write('\n00dde13e404611eb9360036bb7a2b36b;https://www.reddit.com/r/blog/;x;1;2;3;4;09.12.2020;5;6;7;8')
+        req = requests.get("http://localhost:8087/posts/", timeout=5)
+        self.assertEqual((req.status_code, len(req.json())), (200, 100))
+
+    def test_get_posts_date_range(self):
+        print('testing get_posts with post date range')
+        with open(FileReplacer.reddit_test_file_name) as file:
+            expected_count = sum(line.split(';')[7] in ('08.12.2020', '09.12.2020') for line in file)
+        req = requests.get("http://localhost:8087/posts/?from=08.12.2020&to=09.12.2020", timeout=5)
+        post_dates = {post_dict['post date'] for post_dict in req.json()}
+        self.assertEqual((req.status_code, len(req.json()), post_dates),
+                         (200, expected_count, {'08.12.2020', '09.12.2020'}))
+
+    def test_get_posts_incorrect_date_range(self):
+        print('testing get_posts with incorrect post date range')
+        req = requests.get("http://localhost:8087/posts/?from=2020-12-08", timeout=5)
+        self.assertEqual((req.status_code, req.content), (404, b''))
+
     def test_get_line_success(self):
         print('testing get_line success')
         req = requests.get("http://localhost:8087/posts/48dde13e404611eb9360036bb7a2b36b/", timeout=5)
@@ -98,14 +130,14 @@ class TestGET(DirReorganizerMixin, unittest.TestCase):
 
     def test_get_line_no_file(self):
         print('testing get_line with no file detected')
-        path_to_reddit_file = FileWriter.define_path_to_file('reddit-')
+        path_to_reddit_file = FileReplacer.reddit_test_file_name
         os.remove(path_to_reddit_file)
         req = requests.get("http://localhost:8087/posts/48dde13e404611eb9360036bb7a2b36b/", timeout=5)
         self.assertEqual((req.status_code, req.content), (404, b''))
 
     def test_get_line_empty_file(self):
         print('testing get_posts with empty file')
-        path_to_reddit_file = FileWriter.define_path_to_file('reddit-')
+        path_to_reddit_file = FileReplacer.reddit_test_file_name
         with open(path_to_reddit_file, 'w') as file:
             file.write('')
         req = requests.get("http://localhost:8087/posts/48dde13e404611eb9360036bb7a2b36b/", timeout=5)
@@ -116,6 +148,14 @@ class TestGET(DirReorganizerMixin, unittest.TestCase):
         req = requests.get("http://localhost:8087/posts/00dde13e404611eb9360036bb7a2b36b/", timeout=5)
         self.assertEqual((req.status_code, req.content), (404, b''))
 
+    def test_get_line_after_change(self):
+        print('testing get_line after the line has been changed')
+        post_data = PostDataCollection.nonexistent_post_dict
+        url = "http://localhost:8087/posts/48dde13e404611eb9360036bb7a2b36b/"
+        requests.put(url, data=json.dumps(post_data), timeout=5)
+        req = requests.get("http://localhost:8087/posts/00dde13e404611eb9360036bb7a2b36b/", timeout=5)
+        self.assertEqual((req.status_code, req.json()), (200, post_data))
+
     def test_get_url_not_valid(self):
         print('testing get_url is not valid')
         req = requests.get("http://localhost:8087/posts/000dde13e404611eb9360036bb7a2b36b/", timeout=5)
@@ -130,9 +170,38 @@ class TestPOST(DirReorganizerMixin, unittest.TestCase):
         req = requests.post("http://localhost:8087/posts/", data=post_data_json, timeout=5)
         self.assertEqual((req.status_code, req.json()), (201, {'UNIQUE_ID': 101}))
 
+    def test_add_line_date_partition(self):
+        print('testing add_line writes post to the file of its post date')
+        post_data = PostDataCollection.nonexistent_post_dict
+        requests.post("http://localhost:8087/posts/", data=json.dumps(post_data), timeout=5)
+        with open('reddit-20201209.txt') as file:
+            self.assertEqual(file.read()[:32], post_data['UNIQUE_ID'])
+
+    def test_file_writer_keeps_date_partitions(self):
+        print('testing parser output replaces only previous parser output')
+        requests.post("http://localhost:8087/posts/", data=json.dumps(PostDataCollection.nonexistent_post_dict),
+                      timeout=5)
+        file_writer = FileWriter([Post.from_dict(PostDataCollection.existent_post_dict)])
+        names = sorted(name for name in os.listdir(os.getcwd()) if name.startswith('reddit-'))
+        self.assertEqual(names, sorted(['reddit-20201209.txt', file_writer.new_file_name]))
+
+    def test_add_line_concurrent(self):
+        print('testing add_line with concurrent requests')
+        post_data_list = []
+        for ind in range(20):
+            post_data = dict(PostDataCollection.nonexistent_post_dict)
+            post_data['UNIQUE_ID'] = f'{ind:02d}' + post_data['UNIQUE_ID'][2:]
+            post_data_list.append(json.dumps(post_data))
+        with ThreadPoolExecutor(max_workers=20) as executor:
+            reqs = list(executor.map(lambda data: requests.post("http://localhost:8087/posts/", data=data, timeout=5),
+                                     post_data_list))
+        req = requests.get("http://localhost:8087/posts/", timeout=5)
+        line_numbers = sorted(req.json()['UNIQUE_ID'] for req in reqs)
+        self.assertEqual((line_numbers, len(req.json())), (list(range(101, 121)), 120))
+
     def test_add_line_empty_file(self):
         print('testing add_line with empty file')
-        path_to_reddit_file = FileWriter.define_path_to_file('reddit-')
+        path_to_reddit_file = FileReplacer.reddit_test_file_name
         with open(path_to_reddit_file, 'w') as file:
             file.write('')
         post_data = PostDataCollection.existent_post_dict
@@ -154,6 +223,17 @@ class TestPOST(DirReorganizerMixin, unittest.TestCase):
         req = requests.post("http://localhost:8087/posts/", data=post_data_json, timeout=5)
         self.assertEqual((req.status_code, req.content), (404, b''))
 
+    def test_add_line_malformed_json(self):
+        print('testing add_line with malformed JSON')
+        req = requests.post("http://localhost:8087/posts/", data='{bad', timeout=5)
+        self.assertEqual((req.status_code, req.content), (404, b''))
+
+    def test_add_line_delimiter_in_value(self):
+        print('testing add_line with delimiter in value')
+        post_data = dict(PostDataCollection.nonexistent_post_dict, **{'post URL': 'https://www.reddit.com/r/a;b/'})
+        req = requests.post("http://localhost:8087/posts/", data=json.dumps(post_data), timeout=5)
+        self.assertEqual((req.status_code, req.content), (404, b''))
+
     def test_post_url_not_valid(self):
         print('testing post_url is not valid')
         post_data = PostDataCollection.existent_post_dict
@@ -168,16 +248,23 @@ class TestDELETE(DirReorganizerMixin, unittest.TestCase):
         req = requests.delete("http://localhost:8087/posts/48dde13e404611eb9360036bb7a2b36b/", timeout=5)
         self.assertEqual(req.status_code, 200)
 
+    def test_del_line_first_line(self):
+        print('testing del_line of the first line')
+        url = "http://localhost:8087/posts/4751d3fc404611eb9360036bb7a2b36b/"
+        req = requests.delete(url, timeout=5)
+        req_get = requests.get(url, timeout=5)
+        self.assertEqual((req.status_code, req_get.status_code), (200, 404))
+
     def test_del_line_no_file(self):
         print('testing del_line with no file detected')
-        path_to_reddit_file = FileWriter.define_path_to_file('reddit-')
+        path_to_reddit_file = FileReplacer.reddit_test_file_name
         os.remove(path_to_reddit_file)
         req = requests.delete("http://localhost:8087/posts/48dde13e404611eb9360036bb7a2b36b/", timeout=5)
         self.assertEqual(req.status_code, 404)
 
     def test_del_line_empty_file(self):
         print('testing del_line with empty file')
-        path_to_reddit_file = FileWriter.define_path_to_file('reddit-')
+        path_to_reddit_file = FileReplacer.reddit_test_file_name
         with open(path_to_reddit_file, 'w') as file:
             file.write('')
         req = requests.delete("http://localhost:8087/posts/48dde13e404611eb9360036bb7a2b36b/", timeout=5)
@@ -205,7 +292,7 @@ class TestPUT(DirReorganizerMixin, unittest.TestCase):
 
     def test_change_line_no_file(self):
         print('testing change_line with no file detected')
-        path_to_reddit_file = FileWriter.define_path_to_file('reddit-')
+        path_to_reddit_file = FileReplacer.reddit_test_file_name
         os.remove(path_to_reddit_file)
         post_data = PostDataCollection.nonexistent_post_dict
         post_data_json = json.dumps(post_data)
@@ -215,7 +302,7 @@ class TestPUT(DirReorganizerMixin, unittest.TestCase):
 
     def test_change_line_empty_file(self):
         print('testing change_line with empty file')
-        path_to_reddit_file = FileWriter.define_path_to_file('reddit-')
+        path_to_reddit_file = FileReplacer.reddit_test_file_name
         with open(path_to_reddit_file, 'w') as file:
             file.write('')
         post_data = PostDataCollection.existent_post_dict
@@ -257,6 +344,165 @@ class TestPUT(DirReorganizerMixin, unittest.TestCase):
         self.assertEqual(req.status_code, 404)
 
 
+class TestChanges(DirReorganizerMixin, unittest.TestCase):
+    def setUp(self):
+        """Skips the tests if the change feed is disabled, e.g. when the server is run in several worker processes"""
+        super().setUp()
+        if 'X-Last-Seq' not in requests.get("http://localhost:8087/posts/", timeout=5).headers:
+            self.tearDown()
+            self.skipTest('change feed is disabled')
+
+    def test_changes_after_add(self):
+        print('testing changes after add_line')
+        last_seq = int(requests.get("http://localhost:8087/posts/", timeout=5).headers['X-Last-Seq'])
+        post_data = PostDataCollection.nonexistent_post_dict
+        requests.post("http://localhost:8087/posts/", data=json.dumps(post_data), timeout=5)
+        req = requests.get(f"http://localhost:8087/posts/changes?since={last_seq}&timeout=0", timeout=5)
+        expected_changes = [{'seq': last_seq + 1, 'op': 'add', 'id': post_data['UNIQUE_ID'], 'post': post_data}]
+        self.assertEqual((req.status_code, req.json()), (200, {'last_seq': last_seq + 1, 'changes': expected_changes}))
+
+    def test_changes_long_poll(self):
+        print('testing changes long poll')
+        last_seq = int(requests.get("http://localhost:8087/posts/", timeout=5).headers['X-Last-Seq'])
+        url = "http://localhost:8087/posts/48dde13e404611eb9360036bb7a2b36b/"
+        timer = threading.Timer(0.2, requests.delete, args=(url,), kwargs={'timeout': 5})
+        timer.start()
+        req = requests.get(f"http://localhost:8087/posts/changes?since={last_seq}&timeout=5", timeout=10)
+        timer.join()
+        expected_changes = [{'seq': last_seq + 1, 'op': 'delete', 'id': '48dde13e404611eb9360036bb7a2b36b',
+                             'post': None}]
+        self.assertEqual((req.status_code, req.json()['changes']), (200, expected_changes))
+
+    def test_changes_event_stream(self):
+        print('testing changes as Server-Sent Events')
+        last_seq = int(requests.get("http://localhost:8087/posts/", timeout=5).headers['X-Last-Seq'])
+        post_data = dict(PostDataCollection.existent_post_dict, **{'post category': 'news'})
+        url = "http://localhost:8087/posts/48dde13e404611eb9360036bb7a2b36b/"
+        headers = {'Accept': 'text/event-stream'}
+        with requests.get(f"http://localhost:8087/posts/changes?since={last_seq}", headers=headers,
+                          stream=True, timeout=5) as req:
+            requests.put(url, data=json.dumps(post_data), timeout=5)
+            lines = req.iter_lines(chunk_size=1)
+            event = [next(lines), next(lines), next(lines)]
+        self.assertEqual(event[:2], [f'id: {last_seq + 1}'.encode(), b'event: change'])
+
+    def test_changes_after_id_change(self):
+        print('testing changes after change_line with new UNIQUE_ID')
+        last_seq = int(requests.get("http://localhost:8087/posts/", timeout=5).headers['X-Last-Seq'])
+        post_data = PostDataCollection.nonexistent_post_dict
+        url = "http://localhost:8087/posts/48dde13e404611eb9360036bb7a2b36b/"
+        requests.put(url, data=json.dumps(post_data), timeout=5)
+        req = requests.get(f"http://localhost:8087/posts/changes?since={last_seq}&timeout=0", timeout=5)
+        changes = [(change['op'], change['id']) for change in req.json()['changes']]
+        self.assertEqual(changes, [('delete', '48dde13e404611eb9360036bb7a2b36b'), ('add', post_data['UNIQUE_ID'])])
+
+    def test_changes_incorrect_timeout(self):
+        print('testing changes with incorrect timeout')
+        reqs = [requests.get(f"http://localhost:8087/posts/changes?timeout={timeout}", timeout=5)
+                for timeout in ('nan', 'inf', 'soon')]
+        self.assertEqual([req.status_code for req in reqs], [404, 404, 404])
+
+    def test_changes_too_old(self):
+        print('testing changes which are not kept')
+        req = requests.get("http://localhost:8087/posts/changes?since=1000000000&timeout=0", timeout=5)
+        self.assertEqual((req.status_code, list(req.json())), (410, ['last_seq']))
+
+
+class TestTransfer(DirReorganizerMixin, unittest.TestCase):
+    def test_export_ndjson(self):
+        print('testing export in NDJSON format')
+        req = requests.get("http://localhost:8087/export/", timeout=5)
+        posts = [json.loads(line) for line in req.text.splitlines()]
+        self.assertEqual((req.headers['Transfer-Encoding'], len(posts), PostDataCollection.existent_post_dict in posts),
+                         ('chunked', 100, True))
+
+    def test_export_import_csv(self):
+        print('testing export and import in CSV format')
+        export_req = requests.get("http://localhost:8087/export/?format=csv", timeout=5)
+        requests.delete("http://localhost:8087/posts/48dde13e404611eb9360036bb7a2b36b/", timeout=5)
+        req = requests.post("http://localhost:8087/import/?format=csv", data=export_req.content, timeout=5)
+        self.assertEqual((export_req.text.count('\n'), req.status_code, req.json()),
+                         (101, 200, {'imported': 1, 'duplicates': 99, 'invalid': 0}))
+
+    def test_import_ndjson(self):
+        print('testing import in NDJSON format sent in chunks')
+        post_data_list = [PostDataCollection.nonexistent_post_dict, PostDataCollection.existent_post_dict,
+                          PostDataCollection.incorrect_post_dict, PostDataCollection.nonexistent_post_dict]
+        lines = (json.dumps(post_data).encode() + b'\n' for post_data in post_data_list)
+        req = requests.post("http://localhost:8087/import/", data=lines, timeout=5)
+        self.assertEqual((req.status_code, req.json()), (200, {'imported': 1, 'duplicates': 2, 'invalid': 1}))
+
+    def test_publisher_batches(self):
+        print('testing posts publisher sends posts in batches')
+        another_post_data = dict(PostDataCollection.nonexistent_post_dict, UNIQUE_ID='01' + '0' * 30)
+        post_data_list = [PostDataCollection.nonexistent_post_dict, PostDataCollection.existent_post_dict,
+                          another_post_data]
+        with PostsPublisher(batch_size=2) as publisher:
+            counts = publisher([Post.from_dict(post_data) for post_data in post_data_list])
+        req = requests.get("http://localhost:8087/posts/", timeout=5)
+        self.assertEqual((counts, len(req.json())), ({'imported': 2, 'duplicates': 1, 'invalid': 0, 'failed': 0}, 102))
+
+    def test_publisher_flush_on_time(self):
+        print('testing posts publisher sends posts after waiting time')
+        with PostsPublisher(max_wait=0.1) as publisher:
+            publisher.add(Post.from_dict(PostDataCollection.nonexistent_post_dict))
+            time.sleep(0.5)
+            req = requests.get(f"http://localhost:8087/posts/{PostDataCollection.nonexistent_post_dict['UNIQUE_ID']}/",
+                               timeout=5)
+        self.assertEqual((req.status_code, publisher.counts['imported']), (200, 1))
+
+    def test_import_csv_delimiter_in_value(self):
+        print('testing import of CSV values containing delimiter or line break')
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+        writer.writerow(PostDataCollection.nonexistent_post_dict)
+        for ind, post_url in enumerate(['https://www.reddit.com/r/a;b/', 'https://www.reddit.com/r/a\nb/', 'ok']):
+            post_data = dict(PostDataCollection.nonexistent_post_dict, **{'post URL': post_url})
+            post_data['UNIQUE_ID'] = f'{ind:02d}' + post_data['UNIQUE_ID'][2:]
+            writer.writerow(post_data.values())
+        req = requests.post("http://localhost:8087/import/?format=csv", data=buffer.getvalue(), timeout=5)
+        posts_req = requests.get("http://localhost:8087/posts/", timeout=5)
+        self.assertEqual((req.json(), posts_req.status_code, len(posts_req.json())),
+                         ({'imported': 1, 'duplicates': 0, 'invalid': 2}, 200, 101))
+
+    def test_transfer_format_not_valid(self):
+        print('testing export and import format is not valid')
+        export_req = requests.get("http://localhost:8087/export/?format=xml", timeout=5)
+        import_req = requests.post("http://localhost:8087/import/?format=xml", data='<posts/>', timeout=5)
+        self.assertEqual((export_req.status_code, import_req.status_code), (404, 404))
+
+
+class TestJobs(unittest.TestCase):
+    def setUp(self):
+        """Skips the tests if background jobs are disabled, e.g. when the server is run in several worker processes"""
+        if requests.get("http://localhost:8087/jobs/", timeout=5).status_code == 404:
+            self.skipTest('background jobs are disabled')
+
+    def test_get_jobs_success(self):
+        print('testing get_jobs success')
+        req = requests.get("http://localhost:8087/jobs/", timeout=5)
+        self.assertEqual((req.status_code, type(req.json())), (200, list))
+
+    def test_get_job_not_found(self):
+        print('testing get_job not found')
+        req = requests.get("http://localhost:8087/jobs/00dde13e404611eb9360036bb7a2b36b/", timeout=5)
+        self.assertEqual((req.status_code, req.content), (404, b''))
+
+    def test_add_job_incorrect_data(self):
+        print('testing add_job with incorrect data')
+        reqs = [requests.post("http://localhost:8087/jobs/", data=data, timeout=5)
+                for data in (json.dumps({'posts_count': 0}), '{bad')]
+        self.assertEqual([(req.status_code, req.content) for req in reqs], [(404, b''), (404, b'')])
+
+
+class TestImports(unittest.TestCase):
+    def test_server_lazy_imports(self):
+        print('testing server starts without parser dependencies')
+        code = "import server, sys; print(sorted({'bs4', 'requests', 'selenium'} & set(sys.modules)))"
+        output = subprocess.run([sys.executable, '-c', code], capture_output=True, text=True, timeout=30).stdout
+        self.assertEqual(output.strip(), '[]')
+
+
 def test_outcome_file(filename):
     """Defines whether reddit-file is correct. If each line of this file contains exactly 11 values
 
@@ -1,27 +1,100 @@
 import datetime
+import json
 
 
-class DataConverter:
-    @staticmethod
-    def make_str_from_dict(post_dict):
-        """Converts dictionary with post data to string"""
-        post_data_str = ''
-        for data_name in post_dict:
-            data_value = post_dict[data_name]
-            post_data_str += f'{data_value};'
-        return post_data_str[:len(post_data_str) - 1]
+class Post:
+    """Compact record of post data. Fields are kept in the order of reddit-file columns"""
+    __slots__ = ('unique_id', 'post_url', 'username', 'user_karma', 'user_cake_day', 'post_karma',
+                 'comment_karma', 'post_date', 'comments_count', 'votes_count', 'post_category')
+    display_names = ('UNIQUE_ID', 'post URL', 'username', 'user karma', 'user cake day', 'post karma',
+                     'comment karma', 'post date', 'number of comments', 'number of votes', 'post category')
+
+    def __init__(self, unique_id, post_url, username, user_karma, user_cake_day, post_karma, comment_karma,
+                 post_date, comments_count, votes_count, post_category):
+        """Takes post data values in the order of reddit-file columns"""
+        self.unique_id = unique_id
+        self.post_url = post_url
+        self.username = username
+        self.user_karma = user_karma
+        self.user_cake_day = user_cake_day
+        self.post_karma = post_karma
+        self.comment_karma = comment_karma
+        self.post_date = post_date
+        self.comments_count = comments_count
+        self.votes_count = votes_count
+        self.post_category = post_category
+
+    def values(self):
+        """Returns tuple of post data values in the order of reddit-file columns"""
+        return (self.unique_id, self.post_url, self.username, self.user_karma, self.user_cake_day, self.post_karma,
+                self.comment_karma, self.post_date, self.comments_count, self.votes_count, self.post_category)
+
+    def __iter__(self):
+        return iter(self.values())
+
+    def __eq__(self, other):
+        if not isinstance(other, Post):
+            return NotImplemented
+        return self.values() == other.values()
+
+    def __repr__(self):
+        return f'Post{self.values()!r}'
+
+    @classmethod
+    def from_line(cls, line):
+        """Converts string with post data to post record. Raises ValueError if the string is malformed"""
+        values = line.split(';')
+        if len(values) != len(cls.__slots__):
+            raise ValueError(f'Expected {len(cls.__slots__)} values, got {len(values)}')
+        return cls(*values)
+
+    @classmethod
+    def is_line_valid(cls, line):
+        """Defines whether the string contains exactly as many values as reddit-file columns"""
+        return line.count(';') == len(cls.__slots__) - 1
+
+    @classmethod
+    def from_dict(cls, post_dict):
+        """Converts dictionary with post data whose keys are display names of the values to post record.
+
+        Raises ValueError if the dictionary doesn't contain exactly the expected keys or if any value contains
+        ";" or a line break, which would break the line of reddit-file.
+        """
+        if len(post_dict) != len(cls.display_names) or not all(name in post_dict for name in cls.display_names):
+            raise ValueError('Unexpected post data keys')
+        values = [str(post_dict[name]) for name in cls.display_names]
+        for value in values:
+            if ';' in value or value.splitlines() not in ([], [value]):
+                raise ValueError('Post data values must not contain ";" or line breaks')
+        return cls(*values)
+
+    @classmethod
+    def parse_lines(cls, lines):
+        """Converts strings with post data to list of post records"""
+        try:
+            return [cls(*line.split(';')) for line in lines]
+        except TypeError:
+            return [cls.from_line(line) for line in lines]
 
     @staticmethod
-    def make_dict_from_str(data_str):
-        """Converts string with post data to dictionary in a specific sequence"""
-        dict_order = ['UNIQUE_ID', 'post URL', 'username', 'user karma', 'user cake day', 'post karma', 'comment karma',
-                      'post date', 'number of comments', 'number of votes', 'post category']
-        post_data = data_str.replace('\n', '').split(';')
-        post_dict = {}
-        for ind in range(len(dict_order)):
-            post_dict[dict_order[ind]] = post_data[ind]
-        return post_dict
+    def dump_lines(posts):
+        """Converts post records to the content of reddit-file"""
+        return '\n'.join([';'.join(post.values()) for post in posts])
+
+    def to_line(self):
+        """Converts post record to string with post data"""
+        return ';'.join(self.values())
+
+    def to_dict(self):
+        """Converts post record to dictionary whose keys are display names of the values"""
+        return dict(zip(self.display_names, self.values()))
+
+    def to_json(self):
+        """Converts post record to JSON bytes"""
+        return json.dumps(self.to_dict()).encode('utf-8')
+
 
+class DataConverter:
     @staticmethod
     def convert_date(date_str):
         """Takes a string containing time lapse between publishing post and current time.
@@ -38,39 +111,25 @@ class DataConverter:
         return date.strftime("%d.%m.%Y")
 
 
-def check_duplicates(post_data_str, posts_list):
-    """Takes post data string and defines part of it being post unique id. If any of the strings from taken list
-
-    contains the same unique id, returns None (duplicate found); otherwise, returns True (no duplicates).
-    """
-    sent_id = post_data_str[:32]
-    for post_str in posts_list:
-        stored_id = post_str[:32]
-        if sent_id == stored_id:
-            return
-    return True
-
-
-def find_line_index(sent_id, posts_list):
-    """Takes post unique id. If is detected that one of the strings from taken
+def make_date_key(date_str):
+    """Converts date in the format DD.MM.YYYY (the format of post date) to sortable string YYYYMMDD.
 
-    list contains the same unique id, returns line index of this string.
+    Returns None if the date has another format.
     """
-    for ind, post_str in enumerate(posts_list):
-        stored_id = post_str[:32]
-        if sent_id == stored_id:
-            return ind
-    return
+    if len(date_str) == 10 and date_str[2] == '.' and date_str[5] == '.':
+        date_key = date_str[6:] + date_str[3:5] + date_str[:2]
+        if date_key.isdigit():
+            return date_key
 
 
-def parse_url(url):
-    """Parses provided URL. Define whether the URL contains 32-digits UNIQUE_ID. If true, returns this id.
+def parse_url(url, collection='posts'):
+    """Parses provided URL. Define whether the URL contains 32-digits id of collection item. If true, returns this id.
 
-    If the URL contains only the word "posts", returns None. If URL is incorrect, returns 404
+    If the URL contains only the name of collection ("posts" by default), returns None. If URL is incorrect, returns 404
     """
     latest_slash = url[len(url) - 1]
-    if latest_slash == '/' and url[:5] == 'posts':
-        id_start_index = 6
+    if latest_slash == '/' and url[:len(collection)] == collection:
+        id_start_index = len(collection) + 1
         if len(url) > id_start_index:
             id = url[id_start_index:len(url) - 1]
             if len(id) == 32: